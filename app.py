@@ -37,7 +37,7 @@ def run_flask():
         try:
             import webhost
             print("[launcher] starting backend (in-process)", flush=True)
-            webhost.app.run(host="127.0.0.1", port=3478, debug=DebugMode, use_reloader=False)
+            webhost.serve("127.0.0.1", 3478, dev=DebugMode, reload=False)
         except Exception as e:
             print(f"[launcher] backend failed in-process: {e}", flush=True)
     else:
@@ -46,7 +46,7 @@ def run_flask():
         if not os.path.exists(webhost_path):
             print(f"[launcher] ERROR: {webhost_path} not found.", flush=True)
             return
-        FLASK_CMD = [sys.executable, webhost_path, "--no-reload"]
+        FLASK_CMD = [sys.executable, webhost_path, "--no-reload"] + (["--dev"] if DebugMode else [])
         print(f"[launcher] starting backend subprocess: {FLASK_CMD}", flush=True)
         SERVER_PROC = subprocess.Popen(FLASK_CMD, cwd=script_dir, stdout=sys.stdout, stderr=sys.stderr)
         SERVER_PROC.wait()
@@ -103,6 +103,28 @@ class Bridge:
             print(f"[launcher] save_file failed: {e}", flush=True)
             return False
 
+    def save_url(self, suggested_name: str, url: str) -> bool:
+        try:
+            win = webview.windows[0]
+            path = win.create_file_dialog(
+                webview.SAVE_DIALOG,
+                save_filename=suggested_name,
+                file_types=('ZIP (*.zip)',)
+            )
+            if not path:
+                return False
+            out_path = path if isinstance(path, str) else path[0]
+            with urllib.request.urlopen(IP + url) as resp, open(out_path, 'wb') as f:
+                while True:
+                    chunk = resp.read(1 << 16)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            return True
+        except Exception as e:
+            print(f"[launcher] save_url failed: {e}", flush=True)
+            return False
+
 if __name__ == "__main__":
     try:
         import multiprocessing
@@ -0,0 +1,370 @@
+import os, io, sys, json, time, wave, random, struct, base64, shutil, argparse, platform, tempfile, statistics, subprocess, importlib.util
+from PIL import Image, ImageDraw
+from mutagen.wave import WAVE
+from mutagen.id3 import ID3, TIT2, TPE1, TPE2, TALB, TRCK, TPOS, TDRC, TCON, COMM, APIC, POPM, TXXX
+from mutagen.flac import FLAC, Picture
+from mutagen.oggvorbis import OggVorbis
+from mutagen.ogg import OggPage
+from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LONG_TITLE = "An extremely long title that will surely need several lines to wrap " * 2
+LONG_COMMENT = " ".join(["Supercalifragilistic" * 3] + ["a very long comment about the song"] * 60)
+
+FORMAT_MIX = [(".mp3", 40), (".flac", 20), (".m4a", 15), (".ogg", 10), (".wav", 10), (".aac", 5)]
+COVER_MIX = [(0, 10), (300, 15), (600, 35), (1000, 20), (1400, 15), (3000, 5)]
+WORDS = ("midnight", "river", "neon", "golden", "echo", "wild", "paper", "summer", "ghost", "velvet", "broken", "electric",
+         "ocean", "silver", "heart", "city", "dream", "fire", "glass", "north", "café", "señorita", "übermut", "東京", "ночь")
+GENRES = ("Pop", "Rock", "Electronic", "Hip-Hop", "Jazz", "Classical", "Indie", "Metal", "Folk", "Ambient")
+
+def make_track(path, title, artist, comment, seconds=1):
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1); w.setsampwidth(2); w.setframerate(8000)
+        w.writeframes(b"\0\0" * 8000 * seconds)
+    bio = io.BytesIO()
+    Image.new("RGB", (600, 600), (120, 20, 40)).save(bio, format="JPEG")
+    f = WAVE(path)
+    f.add_tags()
+    f.tags.add(TIT2(encoding=3, text=title))
+    f.tags.add(TPE1(encoding=3, text=artist))
+    f.tags.add(COMM(encoding=3, lang="eng", desc="", text=comment))
+    f.tags.add(APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=bio.getvalue()))
+    f.save()
+
+def mp3_bytes(seconds):
+    return (b"\xff\xfb\x90\x64" + b"\0" * 413) * int(seconds * 38.28)
+
+def wav_bytes(seconds):
+    bio = io.BytesIO()
+    with wave.open(bio, "wb") as w:
+        w.setnchannels(2); w.setsampwidth(2); w.setframerate(22050)
+        w.writeframes(b"\0\0\0\0" * 22050 * seconds)
+    return bio.getvalue()
+
+def flac_bytes(seconds):
+    sr, total = 44100, 44100 * seconds
+    si = struct.pack(">HH", 4096, 4096) + b"\0" * 6 + ((sr << 44) | (1 << 41) | (15 << 36) | total).to_bytes(8, "big") + b"\0" * 16
+    return b"fLaC" + b"\x80" + len(si).to_bytes(3, "big") + si + (b"\xff\xf8" + b"\0" * 4094) * (seconds * 40)
+
+def ogg_bytes(seconds):
+    ident = b"\x01vorbis" + struct.pack("<IBIiiiBB", 0, 2, 44100, 0, 128000, 0, 0xB8, 1)
+    comm = b"\x03vorbis" + struct.pack("<I", 6) + b"rately" + struct.pack("<I", 0) + b"\x01"
+    setup = b"\x05vorbis" + b"\0" * 40 + b"\x01"
+    out, pages = io.BytesIO(), seconds * 4
+    for seq, packets in enumerate([[ident], [comm, setup]] + [[b"\0" * 4000]] * pages):
+        p = OggPage(); p.serial = 1; p.sequence = seq; p.packets = packets
+        p.first, p.last = seq == 0, seq == pages + 1
+        p.position = 0 if seq < 2 else 44100 * seconds * (seq - 1) // pages
+        out.write(p.write())
+    return out.getvalue()
+
+def m4a_bytes(seconds):
+    def atom(name, data): return struct.pack(">I", 8 + len(data)) + name + data
+    mvhd = atom(b"mvhd", b"\0\0\0\0" + struct.pack(">IIII", 0, 0, 1000, 1000 * seconds) + b"\0" * 80)
+    mdhd = atom(b"mdhd", b"\0\0\0\0" + struct.pack(">IIII", 0, 0, 44100, 44100 * seconds) + b"\0\0\0\0")
+    hdlr = atom(b"hdlr", b"\0" * 8 + b"soun" + b"\0" * 13)
+    moov = atom(b"moov", mvhd + atom(b"trak", atom(b"mdia", mdhd + hdlr)))
+    return atom(b"ftyp", b"M4A \0\0\0\0M4A mp42isom") + moov + atom(b"mdat", b"\0" * 16000 * seconds)
+
+def aac_bytes(seconds):
+    payload = b"\0" * 364
+    n = 7 + len(payload)
+    header = bytes([0xFF, 0xF1, 0x50, 0x80 | (n >> 11), (n >> 3) & 0xFF, ((n & 7) << 5) | 0x1F, 0xFC])
+    return (header + payload) * int(seconds * 43.07)
+
+AUDIO = {".mp3": mp3_bytes, ".wav": wav_bytes, ".flac": flac_bytes, ".ogg": ogg_bytes, ".m4a": m4a_bytes, ".aac": aac_bytes}
+
+def pick(rng, mix):
+    return rng.choices([v for v, _ in mix], weights=[w for _, w in mix])[0]
+
+def words(rng, lo, hi):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(lo, hi))).title()
+
+def cover_bytes(rng, size):
+    img = Image.new("RGB", (size, size))
+    d = ImageDraw.Draw(img)
+    a, b = [tuple(rng.randrange(256) for _ in range(3)) for _ in range(2)]
+    for y in range(0, size, 4):
+        t = y / size
+        d.rectangle((0, y, size, y + 4), fill=tuple(int(a[i] + (b[i] - a[i]) * t) for i in range(3)))
+    for _ in range(12):
+        x, y, r = rng.randrange(size), rng.randrange(size), rng.randrange(size // 20 + 1, size // 4 + 2)
+        d.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    side = max(1, size // 8)
+    noise = Image.frombytes("L", (side, side), rng.randbytes(side * side)).resize((size, size), Image.BICUBIC).convert("RGB")
+    img = Image.blend(img, noise, 0.08)
+    bio = io.BytesIO()
+    if rng.random() < 0.2:
+        img.save(bio, format="PNG"); return bio.getvalue(), "image/png"
+    img.save(bio, format="JPEG", quality=88); return bio.getvalue(), "image/jpeg"
+
+def tag_track(path, ext, m, cover):
+    if ext in (".mp3", ".wav"):
+        if ext == ".wav":
+            f = WAVE(path); f.add_tags(); tags = f.tags
+        else:
+            tags = ID3()
+        tags.add(TIT2(encoding=3, text=m["title"])); tags.add(TPE1(encoding=3, text=m["artist"]))
+        tags.add(TPE2(encoding=3, text=m["artist"])); tags.add(TALB(encoding=3, text=m["album"]))
+        tags.add(TRCK(encoding=3, text=f"{m['track']}/{m['tracks']}")); tags.add(TPOS(encoding=3, text=f"{m['disc']}/2"))
+        tags.add(TDRC(encoding=3, text=str(m["year"]))); tags.add(TCON(encoding=3, text=m["genre"]))
+        if m["comment"]: tags.add(COMM(encoding=3, lang="eng", desc="", text=m["comment"]))
+        if m["rating"] is not None:
+            tags.add(POPM(email="TuneRater@local", rating=int(round(m["rating"] / 10 * 255)), count=0))
+            tags.add(TXXX(encoding=3, desc="EXACT_RATING", text=[f"{m['rating']:.2f}"]))
+        if cover: tags.add(APIC(encoding=3, mime=cover[1], type=3, desc="Cover", data=cover[0]))
+        f.save() if ext == ".wav" else tags.save(path)
+    elif ext in (".flac", ".ogg"):
+        f = FLAC(path) if ext == ".flac" else OggVorbis(path)
+        f.update(title=m["title"], artist=m["artist"], albumartist=m["artist"], album=m["album"], date=str(m["year"]),
+                 genre=m["genre"], tracknumber=f"{m['track']}/{m['tracks']}", discnumber=str(m["disc"]))
+        if m["comment"]: f["comment"] = m["comment"]
+        if m["rating"] is not None: f["EXACT_RATING"] = f"{m['rating']:.2f}"
+        if cover:
+            pic = Picture(); pic.data, pic.mime, pic.type = cover[0], cover[1], 3
+            if ext == ".flac": f.add_picture(pic)
+            else: f["metadata_block_picture"] = [base64.b64encode(pic.write()).decode("ascii")]
+        f.save()
+    elif ext == ".m4a":
+        f = MP4(path)
+        if f.tags is None: f.add_tags()
+        f.tags.update({"\xa9nam": [m["title"]], "\xa9ART": [m["artist"]], "aART": [m["artist"]], "\xa9alb": [m["album"]],
+                       "\xa9day": [str(m["year"])], "\xa9gen": [m["genre"]], "trkn": [(m["track"], m["tracks"])], "disk": [(m["disc"], 2)]})
+        if m["comment"]: f.tags["\xa9cmt"] = [m["comment"]]
+        if m["rating"] is not None: f.tags["----:com.apple.iTunes:EXACT_RATING"] = [MP4FreeForm(f"{m['rating']:.2f}".encode("utf-8"))]
+        if cover: f.tags["covr"] = [MP4Cover(cover[0], MP4Cover.FORMAT_PNG if cover[1] == "image/png" else MP4Cover.FORMAT_JPEG)]
+        f.save()
+
+def gen_library(root, tracks, seed=1, seconds=2):
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    paths, made = [], 0
+    while made < tracks:
+        artist = words(rng, 1, 3)
+        for _ in range(rng.randint(1, 3)):
+            album, year, genre = words(rng, 1, 4), rng.randint(1965, 2025), rng.choice(GENRES)
+            size = pick(rng, COVER_MIX)
+            cover = cover_bytes(rng, size) if size else None
+            n = min(rng.randint(4, 14), tracks - made)
+            folder = os.path.join(root, artist, f"{album} ({year})") if rng.random() < 0.85 else os.path.join(root, "Singles", artist[:1], artist)
+            os.makedirs(folder, exist_ok=True)
+            for i in range(1, n + 1):
+                ext = pick(rng, FORMAT_MIX)
+                title = LONG_TITLE.strip() if rng.random() < 0.02 else words(rng, 1, 6)
+                r = rng.random()
+                meta = {
+                    "title": title, "artist": artist, "album": album, "year": year, "genre": genre,
+                    "track": i, "tracks": n, "disc": 1 + (i > 10),
+                    "rating": round(rng.uniform(0, 10) * 4) / 4 if r < 0.3 else None,
+                    "comment": LONG_COMMENT if r > 0.98 else (words(rng, 3, 12) if r > 0.8 else None),
+                }
+                path = os.path.join(folder, f"{i:02d} - {title[:60]}{ext}")
+                with open(path, "wb") as fh: fh.write(AUDIO[ext](seconds))
+                try: tag_track(path, ext, meta, cover)
+                except Exception as e: print(f"could not tag {path}: {e}", file=sys.stderr)
+                paths.append(path)
+            made += n
+            if made >= tracks: break
+    return paths
+
+def load_webhost(folder, name=None):
+    spec = importlib.util.spec_from_file_location(name or f"webhost_{abs(hash(folder))}", os.path.join(folder, "webhost.py"))
+    mod = importlib.util.module_from_spec(spec)
+    if name: sys.modules[name] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+def time_cards(mod, path, sizes, runs):
+    mod.draw_card(path, *sizes[0])
+    out = {}
+    for w, h in sizes:
+        t = time.perf_counter()
+        for _ in range(runs): mod.draw_card(path, w, h)
+        out[(w, h)] = (time.perf_counter() - t) / runs * 1000
+    return out
+
+def bench_cards(args):
+    tmp = tempfile.mkdtemp(prefix="rately-bench-")
+    os.environ.setdefault("LOCALAPPDATA", tmp)
+    cases = {
+        "short": os.path.join(tmp, "short.wav"),
+        "long": os.path.join(tmp, "long.wav"),
+    }
+    make_track(cases["short"], "Song title", "Artist", "")
+    make_track(cases["long"], LONG_TITLE, "Artist", LONG_COMMENT)
+    sizes = [(1080, 1440), (2160, 2880)]
+
+    mods = [("current", load_webhost(HERE))]
+    if args.baseline: mods.append(("baseline", load_webhost(os.path.abspath(args.baseline))))
+
+    results = {}
+    try:
+        for name, mod in mods:
+            for case, path in cases.items():
+                for size, ms in time_cards(mod, path, sizes, args.runs).items():
+                    results[(name, case, size)] = ms
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    for case in cases:
+        for w, h in sizes:
+            line = f"card {case:<5} {w}x{h}: {results[('current', case, (w, h))]:8.1f} ms"
+            if args.baseline:
+                base = results[("baseline", case, (w, h))]
+                line += f"   baseline {base:8.1f} ms   x{base / results[('current', case, (w, h))]:.1f}"
+            print(line)
+
+def timed(fn, runs, ops=1):
+    times = []
+    for i in range(runs):
+        t = time.perf_counter()
+        fn(i)
+        times.append((time.perf_counter() - t) * 1000 / ops)
+    return {"median_ms": round(statistics.median(times), 4), "min_ms": round(min(times), 4), "max_ms": round(max(times), 4), "runs": runs, "ops": ops}
+
+def expect(resp, *codes):
+    body = resp.get_data()
+    resp.close()
+    if resp.status_code not in codes: raise RuntimeError(f"unexpected {resp.status_code}: {body[:200]!r}")
+    return body
+
+def git_rev():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception: return None
+
+def run_suite(args):
+    tmp = tempfile.mkdtemp(prefix="rately-suite-")
+    lib, appdata = os.path.join(tmp, "library"), os.path.join(tmp, "appdata")
+    os.environ["LOCALAPPDATA"] = appdata
+    results = {}
+
+    def case(name, fn, runs, ops=1):
+        results[name] = timed(fn, runs, ops)
+        r = results[name]
+        print(f"  {name:<24} {r['median_ms']:10.3f} ms" + (f" /op  ({ops} ops)" if ops > 1 else "") + f"   min {r['min_ms']:.3f}  max {r['max_ms']:.3f}")
+
+    try:
+        t = time.perf_counter()
+        paths = gen_library(lib, args.tracks, args.seed, args.seconds)
+        print(f"generated {len(paths)} tracks in {time.perf_counter() - t:.1f}s")
+
+        mod = load_webhost(HERE, "webhost")
+        mod.CONFIG.update(scan_pool=args.scan_pool) if args.scan_pool else None
+        c = mod.app.test_client()
+        runs = args.runs
+
+        print("library")
+        case("set_library", lambda i: expect(c.post("/set_library", json={"path": lib}), 200), 1)
+        case("tracks_cold", lambda i: expect(c.get("/api/tracks"), 200), 1)
+        case("tracks_warm", lambda i: expect(c.get("/api/tracks"), 200), runs)
+        case("tracks_warm_ndjson", lambda i: expect(c.get("/api/tracks?format=ndjson&fields=id,title,artist,rating_exact,mtime"), 200), runs)
+        case("scan_files", lambda i: mod.scan_files(lib), runs)
+        fresh = load_webhost(HERE)
+        fresh.set_config(library=lib)
+        case("tracks_cold_index", lambda i: expect(fresh.app.test_client().get("/api/tracks"), 200), 1)
+        if len(json.loads(expect(fresh.app.test_client().get("/api/tracks"), 200))["tracks"]) != len(paths):
+            raise RuntimeError("tracks_cold_index did not load the library")
+
+        tracks = c.get("/api/tracks").get_json()["tracks"]
+        tids = [t["id"] for t in tracks]
+        by_path = {mod.path_for_tid(tid): tid for tid in tids}
+        case("tid_resolve", lambda i: [mod.path_for_tid(tid) for tid in tids], runs, len(tids))
+
+        print("covers")
+        big = max((mod.read_meta(p)["cover"] + (p,) for p in paths[:200]), key=lambda x: len(x[0] or b""))
+        if big[0]:
+            case("resize_image_bytes", lambda i: mod.resize_image_bytes(big[0], big[1], 300), runs)
+        cold = iter(tids)
+        case("cover_cold", lambda i: expect(c.get(f"/cover/{next(cold)}?w=300"), 200), min(runs, len(tids)))
+        case("cover_warm", lambda i: expect(c.get(f"/cover/{tids[0]}?w=300"), 200), runs)
+        case("sprite_100", lambda i: expect(c.get(f"/api/sprite?w=96&ids={','.join(tids[:100])}"), 200), runs)
+
+        print("cards")
+        card = mod.path_for_tid(tids[0])
+        case("draw_card", lambda i: mod.draw_card(card, 1080, 1440), runs)
+        cold = iter(tids[1:])
+        case("render_cold", lambda i: expect(c.get(f"/api/render/{next(cold)}/card.png"), 200), min(runs, len(tids) - 1))
+        case("render_warm", lambda i: expect(c.get(f"/api/render/{tids[0]}/card.png"), 200), runs)
+        case("render_preview", lambda i: expect(c.get(f"/api/render/{tids[-1 - i]}/card.png?quality=preview"), 200), min(runs, len(tids)))
+
+        print("audio")
+        audio = max(tids, key=lambda tid: os.path.getsize(mod.path_for_tid(tid)))
+        case("audio_full", lambda i: expect(c.get(f"/audio/{audio}"), 200), runs)
+        case("audio_range_64k", lambda i: expect(c.get(f"/audio/{audio}", headers={"Range": "bytes=0-65535"}), 206), runs)
+        case("audio_range_suffix", lambda i: expect(c.get(f"/audio/{audio}", headers={"Range": "bytes=-4096"}), 206), runs)
+        case("audio_multi_range", lambda i: expect(c.get(f"/audio/{audio}", headers={"Range": "bytes=0-99,1000-1099,-100"}), 206), runs)
+
+        print("ratings")
+        writable = [p for p in paths if not p.endswith(".aac")]
+        case("write_rating", lambda i: mod.write_rating(writable[i % len(writable)], (i % 20) / 2, None), min(runs * 4, len(writable)))
+        case("write_rating_comment", lambda i: mod.write_rating(writable[i % len(writable)], 7.5, f"bench {i}"), min(runs * 4, len(writable)))
+        batch = [by_path[p] for p in writable[:args.bulk]]
+        case("rate_bulk", lambda i: expect(c.post("/api/rate_bulk", json={"items": [{"id": tid, "rating": 5 + i % 5} for tid in batch], "wait": True}), 200), max(1, runs // 2), len(batch))
+        st = c.get("/api/rate_status").get_json()
+        results["rate_bytes_per_write"] = round(st.get("bytes_written", 0) / max(1, st.get("written", 1)))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_rev(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "tracks": args.tracks, "seed": args.seed, "seconds": args.seconds, "runs": args.runs,
+        "results": results,
+    }
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f: previous = json.load(f)
+    write_report(report, previous, args.out, args.json)
+
+def write_report(report, previous, out, out_json):
+    lines = [f"Rately benchmark  {report['created']}  commit {report['commit'] or '?'}  python {report['python']}  cpus {report['cpus']}",
+             f"{report['tracks']} tracks, seed {report['seed']}, {report['runs']} runs", ""]
+    prev = (previous or {}).get("results", {})
+    for name, r in report["results"].items():
+        if not isinstance(r, dict):
+            lines.append(f"{name:<24} {r:>12}")
+            continue
+        line = f"{name:<24} {r['median_ms']:12.3f} ms" + (" /op" if r["ops"] > 1 else "   ")
+        old = prev.get(name)
+        if isinstance(old, dict) and old.get("median_ms"):
+            ratio = r["median_ms"] / old["median_ms"]
+            line += f"   was {old['median_ms']:10.3f}   x{ratio:.2f}" + ("  SLOWER" if ratio > 1.15 else "")
+        lines.append(line)
+    text = "\n".join(lines) + "\n"
+    print("\n" + text)
+    with open(out, "w", encoding="utf-8") as f: f.write(text)
+    with open(out_json, "w", encoding="utf-8") as f: json.dump(report, f, indent=2)
+    print(f"wrote {out} and {out_json}")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Rately benchmarks")
+    sub = ap.add_subparsers(dest="cmd")
+
+    s = sub.add_parser("suite", help="generate a library and time the main endpoints through the Flask test client")
+    s.add_argument("--tracks", type=int, default=500)
+    s.add_argument("--seed", type=int, default=1)
+    s.add_argument("--seconds", type=int, default=2, help="length of each generated track")
+    s.add_argument("--runs", type=int, default=10)
+    s.add_argument("--bulk", type=int, default=100, help="tracks per /api/rate_bulk call")
+    s.add_argument("--scan-pool", choices=("process", "thread"))
+    s.add_argument("--out", default=os.path.join(HERE, "bench_output.txt"))
+    s.add_argument("--json", default=os.path.join(HERE, "bench_output.json"))
+    s.add_argument("--compare", help="earlier bench_output.json to compare against")
+
+    c = sub.add_parser("cards", help="time draw_card on short and long cards")
+    c.add_argument("--runs", type=int, default=5)
+    c.add_argument("--baseline", help="folder holding another webhost.py to compare against")
+
+    g = sub.add_parser("gen", help="write a synthetic library to a folder")
+    g.add_argument("folder")
+    g.add_argument("--tracks", type=int, default=500)
+    g.add_argument("--seed", type=int, default=1)
+    g.add_argument("--seconds", type=int, default=2)
+
+    args = ap.parse_args()
+    if args.cmd == "cards": bench_cards(args)
+    elif args.cmd == "gen": print(f"wrote {len(gen_library(args.folder, args.tracks, args.seed, args.seconds))} tracks to {args.folder}")
+    else: run_suite(args if args.cmd else s.parse_args([]))
@@ -1,13 +1,19 @@
-from flask import Flask, request, jsonify, send_file, Response, abort, render_template
-import os, io, re, json, base64, hashlib, mimetypes, threading, uuid, PIL
+from flask import Flask, request, jsonify, send_file, Response, abort, render_template, g
+import os, io, re, sys, gzip, zlib, json, time, heapq, socket, weakref, selectors, cProfile, pstats, base64, bisect, hashlib, mimetypes, threading, uuid, sqlite3, queue, zipfile, multiprocessing, unicodedata, PIL
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque, defaultdict, OrderedDict
 from PIL import Image, ImageDraw, ImageFont, ImageFilter 
-from functools import lru_cache
 from datetime import datetime
+from functools import lru_cache
+from itertools import filterfalse
+from contextlib import contextmanager
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
 
-from mutagen.id3 import ID3, ID3NoHeaderError, POPM, COMM, TXXX
-from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+from mutagen.id3 import ID3, ID3NoHeaderError, POPM, COMM, TXXX, APIC, Frames, Frames_2_2
+from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm, MP4Tags
 from mutagen.oggvorbis import OggVorbis
-from mutagen.flac import FLAC, Picture
+from mutagen.flac import FLAC, Picture, MetadataBlock
+from mutagen.mp3 import MP3
 from mutagen import File as MutaFile
 from mutagen.wave import WAVE
 
@@ -18,6 +24,25 @@ try:
 except Exception:
     TK_OK = False
 
+try:
+    import waitress
+    WAITRESS_OK = True
+except Exception:
+    WAITRESS_OK = False
+
+try:
+    import brotli
+    BROTLI_OK = True
+except Exception:
+    BROTLI_OK = False
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_OK = True
+except Exception:
+    WATCHDOG_OK = False
+
 app = Flask(__name__)
 app.url_map.strict_slashes = False
 
@@ -25,9 +50,13 @@ FORCE_SELECT_ON_START = True
 forcedpath = [False, r"C:\Users\User\Music"]
 hostall = [False, 5000]
 CONFIG_PATH = os.path.join(os.environ["LOCALAPPDATA"], "Rately", "config.json")
+INDEX_PATH = os.path.join(os.path.dirname(CONFIG_PATH), "index.db")
+CACHE_DIR = os.path.join(os.path.dirname(CONFIG_PATH), "cache")
 
 CONFIG = {"library": None}
-print(f"Config will be stored in {CONFIG_PATH}")
+IS_WORKER = multiprocessing.current_process().name != "MainProcess"
+if not IS_WORKER:
+    print(f"Config will be stored in {CONFIG_PATH}")
 
 DEFAULT_IMAGE_SIZE = (1080, 1440)
 THEME = {
@@ -41,6 +70,7 @@ THEME = {
 }
 
 ALLOWED = {".mp3", ".ogg", ".wav", ".m4a", ".flac", ".aac"}
+TAGGABLE = {".mp3", ".ogg", ".wav", ".m4a", ".flac"}
 os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
 if os.path.exists(CONFIG_PATH):
     try:
@@ -54,15 +84,116 @@ if forcedpath[0] == True:
 if __name__ != "__main__":
     hostall = [False, 3478]
 
-def save_config():
-    try:
-        json.dump(CONFIG, open(CONFIG_PATH, "w", encoding="utf-8"), indent=2)
-    except:
-        pass
+CONFIG_LOCK = threading.RLock()
 
-if FORCE_SELECT_ON_START:
-    CONFIG["library"] = None
-    save_config()
+def save_config():
+    with CONFIG_LOCK:
+        tmp = f"{CONFIG_PATH}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(dict(CONFIG), f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, CONFIG_PATH)
+        except:
+            try: os.remove(tmp)
+            except OSError: pass
+
+def set_config(**values):
+    with CONFIG_LOCK:
+        CONFIG.update(values)
+        save_config()
+
+if FORCE_SELECT_ON_START and not IS_WORKER:
+    set_config(library=None)
+
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_HELP = {
+    "rately_request_seconds": ("histogram", "Time to serve a request, up to the end of the body (or the headers, for files handed straight to the server)"),
+    "rately_requests_total": ("counter", "Requests served by route and status"),
+    "rately_phase_seconds": ("histogram", "Time spent in one phase of metadata reads, card renders and rating writes"),
+    "rately_cache_requests_total": ("counter", "Cache lookups by cache and result"),
+    "rately_tag_bytes_written_total": ("counter", "Bytes written to audio files by rating saves"),
+    "rately_cache_bytes": ("gauge", "Bytes held by each cache"),
+    "rately_tracks": ("gauge", "Tracks in the loaded catalog"),
+    "rately_rate_pending": ("gauge", "Rating writes waiting to be saved"),
+}
+METRICS = {"hist": {}, "count": {}}
+METRICS_LOCK = threading.Lock()
+
+def observe(name: str, seconds: float, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        h = METRICS["hist"].get(key)
+        if h is None: h = METRICS["hist"][key] = [[0] * (len(METRIC_BUCKETS) + 1), 0.0]
+        h[0][bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        h[1] += seconds
+
+def count(name: str, n: int = 1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with METRICS_LOCK:
+        METRICS["count"][key] = METRICS["count"].get(key, 0) + n
+
+def cache_result(cache: str, hit) -> None:
+    count("rately_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+class Phases:
+    def __init__(self, prefix: str, **labels):
+        self.prefix, self.labels, self.t = prefix, labels, time.perf_counter()
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        observe("rately_phase_seconds", now - self.t, phase=f"{self.prefix}.{name}", **self.labels)
+        self.t = now
+
+class RWLock:
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers, self.writing, self.waiting = 0, False, 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writing or self.waiting: self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers: self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.waiting += 1
+            while self.writing or self.readers: self.cond.wait()
+            self.waiting -= 1
+            self.writing = True
+
+    def release_write(self):
+        with self.cond:
+            self.writing = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try: yield
+        finally: self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try: yield
+        finally: self.release_write()
+
+FILE_LOCKS = weakref.WeakValueDictionary()
+FILE_LOCKS_LOCK = threading.Lock()
+
+def file_lock(path: str) -> RWLock:
+    key = os.path.normcase(os.path.abspath(path))
+    with FILE_LOCKS_LOCK:
+        lock = FILE_LOCKS.get(key)
+        if lock is None: lock = FILE_LOCKS[key] = RWLock()
+        return lock
 
 def b64u(s: bytes) -> str:
     return base64.urlsafe_b64encode(s).decode().rstrip("=")
@@ -70,12 +201,18 @@ def b64u(s: bytes) -> str:
 def tid_for(path: str) -> str:
     return b64u(hashlib.sha1(path.encode("utf-8", "ignore")).digest())
 
-@lru_cache(maxsize=8192)
 def path_for_tid(tid: str) -> str:
-    for p in scan_files(CONFIG.get("library") or ""):
-        if tid_for(p) == tid:
-            return p
-    raise FileNotFoundError
+    root = CONFIG.get("library")
+    if not root: raise FileNotFoundError
+    if CATALOG["root"] != root: load_catalog(root)
+    if not CATALOG["scanned"]: start_scan(root)
+    with INDEX_LOCK:
+        p = CATALOG["ids"].get(tid)
+    if p is None: raise FileNotFoundError
+    if not os.path.isfile(p):
+        forget_paths([p])
+        raise FileNotFoundError
+    return p
 
 def scan_files(root: str):
     if not root or not os.path.isdir(root): return []
@@ -111,9 +248,8 @@ def set_immutable_cache(resp, etag: str, last_mod_ts: int):
     return resp
 
 def client_conditional_hit(etag: str, last_mod_ts: int) -> bool:
-    inm = request.headers.get('If-None-Match')
+    if request.headers.get('If-None-Match'): return etag_match(etag)
     ims = request.headers.get('If-Modified-Since')
-    if inm and inm == etag: return True
     if ims:
         try:
             return int(datetime.strptime(ims, '%a, %d %b %Y %H:%M:%S GMT').timestamp()) >= int(last_mod_ts)
@@ -131,15 +267,47 @@ def ensure_emoji_safe(txt: str) -> str:
         pass
     return _emoji_re.sub(lambda m: ''.join([f'\\U{ord(c):08X}' for c in m.group(0)]), txt)
 
-def read_meta(path: str):
+class _PictureStub(MetadataBlock):
+    def __init__(self, data):
+        self.data = b""
+
+class _ListingFLAC(FLAC):
+    METADATA_BLOCKS = FLAC.METADATA_BLOCKS[:Picture.code] + [_PictureStub]
+
+class _APICStub(APIC):
+    FrameID = "APIC"
+
+    @classmethod
+    def _fromData(cls, header, tflags, data):
+        return cls(data=b"")
+
+LISTING_FRAMES = {**Frames_2_2, **Frames, "APIC": _APICStub, "PIC": _APICStub}
+
+class _ListingMP4Tags(MP4Tags):
+    def load(self, atoms, fileobj):
+        try: ilst = atoms.path(b"moov", b"udta", b"meta", b"ilst")[-1]
+        except KeyError: ilst = None
+        covr = []
+        if ilst is not None:
+            covr = [a for a in ilst.children if a.name == b"covr"]
+            ilst.children = [a for a in ilst.children if a.name != b"covr"]
+        super().load(atoms, fileobj)
+        if covr: super(MP4Tags, self).__setitem__("covr", [MP4Cover(b"")])
+
+class _ListingMP4(MP4):
+    MP4Tags = _ListingMP4Tags
+
+def read_meta(path: str, covers: bool = True, sidecar: bool = True):
     ext = os.path.splitext(path)[1].lower()
     title = artist = comment = album = None
     duration = None
     rating_exact = None
     rating_approx = None
     cover_bytes, cover_mime = None, None
+    has_cover = False
     track_raw = None
     disc_raw = None
+    phases = Phases("read_meta", fmt=ext.lstrip(".") or "none")
 
     def parse_tracklike(v):
         if v is None: return (None, None)
@@ -150,98 +318,100 @@ def read_meta(path: str):
         total = int(m.group(2)) if m.group(2) else None
         return (t, total)
 
-    try:
-        mf = MutaFile(path, easy=True)
-        if mf and getattr(mf, "info", None):
-            try: duration = float(mf.info.length)
+    def length_of(mf):
+        try: return float(mf.info.length)
+        except: return None
+
+    def from_id3(tags):
+        nonlocal title, artist, album, comment, rating_exact, cover_bytes, cover_mime, has_cover, track_raw, disc_raw
+        title  = safe(title,  (tags.get("TIT2").text[0] if tags.get("TIT2") else None))
+        artist = safe(artist, (tags.get("TPE1").text[0] if tags.get("TPE1") else None))
+        album  = safe(album,  (tags.get("TALB").text[0] if tags.get("TALB") else None))
+        if not comment:
+            comms = [f.text for f in tags.getall("COMM")]
+            if comms:
+                comment = ", ".join([c if isinstance(c, str) else "".join(c) for c in comms])
+        pops = tags.getall("POPM")
+        if pops:
+            popv = max([getattr(p, "rating", 0) for p in pops])
+            rating_exact = round((popv/255.0)*10.0, 2)
+        tx = [t for t in tags.getall("TXXX") if t.desc.upper() == "EXACT_RATING"]
+        if tx:
+            try: rating_exact = float(tx[0].text[0])
             except: pass
-        if mf:
-            title = (mf.get("title", [None]) or [None])[0]
-            artist = (mf.get("artist", [None]) or [None])[0]
-            album = (mf.get("album", [None]) or [None])[0]
-            comment = (mf.get("comment", [None]) or [None])[0]
-            tr = (mf.get("tracknumber", [None]) or [None])[0]
-            dn = (mf.get("discnumber", [None]) or [None])[0]
-            track_raw = tr
-            disc_raw = dn
-    except Exception:
-        pass
+        apics = tags.getall("APIC")
+        if apics:
+            has_cover = True
+            if covers:
+                cover_bytes = apics[0].data
+                cover_mime = apics[0].mime or "image/jpeg"
+        if not track_raw and tags.get("TRCK"):
+            track_raw = tags.get("TRCK").text[0]
+        if not disc_raw and tags.get("TPOS"):
+            disc_raw = tags.get("TPOS").text[0]
+
+    def from_vorbis(vc):
+        nonlocal title, artist, album, comment, rating_exact, track_raw, disc_raw
+        title  = safe(title,  vc.get("title",  [None])[0])
+        artist = safe(artist, vc.get("artist", [None])[0])
+        album  = safe(album,  vc.get("album",  [None])[0])
+        comment = safe(comment, vc.get("comment", [None])[0] or vc.get("description", [None])[0])
+        if "EXACT_RATING" in vc:
+            try: rating_exact = float(vc["EXACT_RATING"][0])
+            except: pass
+        elif "RATING" in vc:
+            try: rating_exact = round(float(vc["RATING"][0])/10.0, 2)
+            except: pass
+        elif "FMPS_RATING" in vc:
+            try: rating_exact = round(float(vc["FMPS_RATING"][0])*10.0, 2)
+            except: pass
+        track_raw = track_raw or (vc.get("tracknumber",[None])[0])
+        disc_raw  = disc_raw  or (vc.get("discnumber",[None])[0])
 
+    lock = file_lock(path)
+    lock.acquire_read()
+    fh = None
     try:
+        fh = open(path, "rb")
+        phases.mark("open")
         if ext == ".mp3":
-            try: tags = ID3(path)
-            except ID3NoHeaderError: tags = ID3()
-            title  = safe(title,  (tags.get("TIT2").text[0] if tags.get("TIT2") else None))
-            artist = safe(artist, (tags.get("TPE1").text[0] if tags.get("TPE1") else None))
-            album  = safe(album,  (tags.get("TALB").text[0] if tags.get("TALB") else None))
-            if not comment:
-                comms = [f.text for f in tags.getall("COMM")]
-                if comms:
-                    comment = ", ".join([c if isinstance(c, str) else "".join(c) for c in comms])
-            pops = tags.getall("POPM")
-            if pops:
-                popv = max([getattr(p, "rating", 0) for p in pops])
-                rating_exact = round((popv/255.0)*10.0, 2)
-            tx = [t for t in tags.getall("TXXX") if t.desc.upper() == "EXACT_RATING"]
-            if tx:
-                try: rating_exact = float(tx[0].text[0])
-                except: pass
-            apics = tags.getall("APIC")
-            if apics:
-                cover_bytes = apics[0].data
-                cover_mime = apics[0].mime or "image/jpeg"
-            if not track_raw and tags.get("TRCK"):
-                track_raw = tags.get("TRCK").text[0]
-            if not disc_raw and tags.get("TPOS"):
-                disc_raw = tags.get("TPOS").text[0]
+            frames = None if covers else LISTING_FRAMES
+            try:
+                mf = MP3(fh, known_frames=frames)
+                duration = length_of(mf)
+                tags = mf.tags
+            except Exception:
+                fh.seek(0)
+                try: tags = ID3(fh, known_frames=frames)
+                except ID3NoHeaderError: tags = None
+            if tags is not None: from_id3(tags)
 
         elif ext == ".flac":
-            f = FLAC(path)
-            title  = safe(title,  f.get("title",  [None])[0])
-            artist = safe(artist, f.get("artist", [None])[0])
-            album  = safe(album,  f.get("album",  [None])[0])
-            comment = safe(comment, f.get("comment", [None])[0] or f.get("description", [None])[0])
-            if "EXACT_RATING" in f:
-                try: rating_exact = float(f["EXACT_RATING"][0])
-                except: pass
-            elif "RATING" in f:
-                try: rating_exact = round(float(f["RATING"][0])/10.0, 2)
-                except: pass
-            elif "FMPS_RATING" in f:
-                try: rating_exact = round(float(f["FMPS_RATING"][0])*10.0, 2)
-                except: pass
+            f = FLAC(fh) if covers else _ListingFLAC(fh)
+            duration = length_of(f)
+            if f.tags is not None: from_vorbis(f)
             if f.pictures:
-                cover_bytes = f.pictures[0].data
-                cover_mime = f.pictures[0].mime
-            track_raw = track_raw or (f.get("tracknumber",[None])[0])
-            disc_raw  = disc_raw  or (f.get("discnumber",[None])[0])
+                has_cover = True
+                if covers:
+                    cover_bytes = f.pictures[0].data
+                    cover_mime = f.pictures[0].mime
 
         elif ext == ".ogg":
-            og = OggVorbis(path)
-            title  = safe(title,  og.get("title",  [None])[0])
-            artist = safe(artist, og.get("artist", [None])[0])
-            album  = safe(album,  og.get("album",  [None])[0])
-            comment = safe(comment, og.get("comment", [None])[0])
-            if "EXACT_RATING" in og:
-                try: rating_exact = float(og["EXACT_RATING"][0])
-                except: pass
-            elif "RATING" in og:
-                try: rating_exact = round(float(og["RATING"][0])/10.0, 2)
-                except: pass
-            elif "FMPS_RATING" in og:
-                try: rating_exact = round(float(og["FMPS_RATING"][0])*10.0, 2)
-                except: pass
+            og = OggVorbis(fh)
+            duration = length_of(og)
+            from_vorbis(og)
             picb64 = og.get("metadata_block_picture", [])
             if picb64:
-                try:
-                    pic = Picture(base64.b64decode(picb64[0]))
-                    cover_bytes, cover_mime = pic.data, pic.mime
-                except: pass
-            track_raw = track_raw or (og.get("tracknumber",[None])[0])
-            disc_raw  = disc_raw  or (og.get("discnumber",[None])[0])
+                has_cover = True
+                if covers:
+                    try:
+                        pic = Picture(base64.b64decode(picb64[0]))
+                        cover_bytes, cover_mime = pic.data, pic.mime
+                    except: pass
 
         elif ext == ".m4a":
-            mp = MP4(path)
+            mp = MP4(fh) if covers else _ListingMP4(fh)
+            duration = length_of(mp)
             if mp.tags:
                 title  = safe(title,  (mp.tags.get("\xa9nam", [None]) or [None])[0])
                 artist = safe(artist, (mp.tags.get("\xa9ART", [None]) or [None])[0])
@@ -256,45 +426,41 @@ def read_meta(path: str):
                     except: pass
                 cov = mp.tags.get("covr")
                 if cov:
-                    c = cov[0]
-                    cover_bytes = bytes(c)
-                    cover_mime = "image/png" if c.imageformat == MP4Cover.FORMAT_PNG else "image/jpeg"
+                    has_cover = True
+                    if covers:
+                        c = cov[0]
+                        cover_bytes = bytes(c)
+                        cover_mime = "image/png" if c.imageformat == MP4Cover.FORMAT_PNG else "image/jpeg"
                 tr = mp.tags.get("trkn", [(None,None)])[0]
                 dn = mp.tags.get("disk", [(None,None)])[0]
                 if tr and tr[0]: track_raw = str(tr[0])
                 if dn and dn[0]: disc_raw  = str(dn[0])
 
         elif ext == ".wav":
-            w = WAVE(path)
+            w = WAVE(fh, known_frames=None if covers else LISTING_FRAMES)
+            duration = length_of(w)
             try:
-                tags = w.tags
-                if tags:
-                    title  = safe(title,  tags.get("TIT2").text[0] if tags.get("TIT2") else None)
-                    artist = safe(artist, tags.get("TPE1").text[0] if tags.get("TPE1") else None)
-                    album  = safe(album,  tags.get("TALB").text[0] if tags.get("TALB") else None)
-                    if not comment:
-                        comms = [f.text for f in tags.getall("COMM")]
-                        if comms:
-                            comment = ", ".join([c if isinstance(c, str) else "".join(c) for c in comms])
-                    pops = tags.getall("POPM")
-                    if pops:
-                        popv = max([getattr(p, "rating", 0) for p in pops])
-                        rating_exact = round((popv/255.0)*10.0, 2)
-                    tx = [t for t in tags.getall("TXXX") if t.desc.upper() == "EXACT_RATING"]
-                    if tx:
-                        try: rating_exact = float(tx[0].text[0])
-                        except: pass
-                    apics = tags.getall("APIC")
-                    if apics:
-                        cover_bytes = apics[0].data
-                        cover_mime = apics[0].mime or "image/jpeg"
-                    if tags.get("TRCK"): track_raw = tags.get("TRCK").text[0]
-                    if tags.get("TPOS"): disc_raw  = tags.get("TPOS").text[0]
+                if w.tags: from_id3(w.tags)
             except:
                 pass
 
+        else:
+            mf = MutaFile(fh, easy=True)
+            if mf:
+                duration = length_of(mf)
+                title = (mf.get("title", [None]) or [None])[0]
+                artist = (mf.get("artist", [None]) or [None])[0]
+                album = (mf.get("album", [None]) or [None])[0]
+                comment = (mf.get("comment", [None]) or [None])[0]
+                track_raw = (mf.get("tracknumber", [None]) or [None])[0]
+                disc_raw = (mf.get("discnumber", [None]) or [None])[0]
+
     except Exception:
         pass
+    finally:
+        if fh: fh.close()
+        lock.release_read()
+    phases.mark("parse")
 
     title = safe(title, "Unknown Title")
     artist = safe(artist, "Unknown Artist")
@@ -310,25 +476,69 @@ def read_meta(path: str):
     else:
         rating_approx = None
 
-    return {
+    meta = {
         "title": title, "artist": artist, "album": album,
         "duration": duration,
         "track_no": tnum, "disc_no": dnum,
         "rating_exact": rating_exact, "rating_stars": rating_approx,
-        "comment": comment, "has_cover": bool(cover_bytes),
+        "comment": comment, "has_cover": has_cover,
         "cover": (cover_bytes, cover_mime)
     }
-
-def write_rating(path: str, r10: float | None, comment_text: str | None):
+    if not sidecar: return meta
+    meta = sidecar_overlay(path, meta)
+    phases.mark("sidecar")
+    return meta
+
+TAG_PADDING_KB = int(CONFIG.get("tag_padding_kb") or 32)
+
+class TagWriter:
+    def __init__(self, f):
+        self.f, self.bytes, self.resized = f, 0, False
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self.f.write(data)
+
+    def padding(self, info):
+        if info.padding >= 0: return info.padding
+        self.resized = True
+        return TAG_PADDING_KB * 1024 + min(info.size // 1000, 1024 * 1024)
+
+def save_tags(obj, path: str, phases: Phases | None = None, **kw) -> dict:
+    if phases: phases.mark("load")
+    with open(path, "rb+") as fh:
+        out = TagWriter(fh)
+        obj.save(out, padding=out.padding, **kw)
+    if phases: phases.mark("save")
+    count("rately_tag_bytes_written_total", out.bytes, fmt=os.path.splitext(path)[1].lower().lstrip("."))
+    return {"bytes_written": out.bytes, "resized": out.resized, "size": os.path.getsize(path)}
+
+def write_rating(path: str, r10: float | None, comment_text: str | list | None):
+    with file_lock(path).write():
+        return _write_rating(path, r10, comment_text)
+
+def _write_rating(path: str, r10: float | None, comment_text: str | list | None):
+    comments = [c for c in (comment_text if isinstance(comment_text, list) else [comment_text]) if c]
     def clamp(v, lo, hi): return max(lo, min(hi, v))
     def is_noneish(x):
         try: return x is None or (isinstance(x, float) and (x != x))
         except: return x is None
     ext = os.path.splitext(path)[1].lower()
+    phases = Phases("write_rating", fmt=ext.lstrip("."))
 
     if not is_noneish(r10):
         r10 = round(clamp(float(r10), 0.0, 10.0), 2)
 
+    def id3_comment(tags):
+        comms = [f.text for f in tags.getall("COMM")]
+        return ", ".join([c if isinstance(c, str) else "".join(c) for c in comms]) if comms else None
+
+    def written(comment, saved):
+        return dict(saved, rating_exact=None if is_noneish(r10) else r10, comment=safe(comment, None))
+
     def append_comment(existing, newtxt):
         if not newtxt: return existing
         newtxt = ensure_emoji_safe(newtxt)
@@ -346,8 +556,9 @@ def write_rating(path: str, r10: float | None, comment_text: str | None):
                 pop = int(round((r10/10.0)*255))
                 tags.delall("POPM"); tags.add(POPM(email="TuneRater@local", rating=pop, count=0))
                 tags.delall("TXXX:EXACT_RATING"); tags.add(TXXX(encoding=3, desc="EXACT_RATING", text=[f"{r10:.2f}"]))
-            if comment_text: tags.add(COMM(encoding=3, lang="eng", desc="", text=ensure_emoji_safe(comment_text)))
-            tags.save(path)
+            if comments: tags.setall("COMM::eng", [COMM(encoding=3, lang="eng", desc="", text=ensure_emoji_safe(comments[-1]))])
+            saved = save_tags(tags, path, phases)
+            return written(id3_comment(tags), saved)
         except Exception as e:
             raise
 
@@ -360,10 +571,11 @@ def write_rating(path: str, r10: float | None, comment_text: str | None):
             f["RATING"] = [str(int(round(r10*10)))]
             f["EXACT_RATING"] = [f"{r10:.2f}"]
             f["FMPS_RATING"] = [f"{r10/10.0:.3f}"]
-        if comment_text:
+        for c in comments:
             prev = f.get("comment", [None])[0]
-            f["comment"] = [append_comment(prev, comment_text)]
-        f.save()
+            f["comment"] = [append_comment(prev, c)]
+        saved = save_tags(f, path, phases)
+        return written(f.get("comment", [None])[0] or f.get("description", [None])[0], saved)
 
     elif ext == ".ogg":
         og = OggVorbis(path)
@@ -374,10 +586,11 @@ def write_rating(path: str, r10: float | None, comment_text: str | None):
             og["RATING"] = [str(int(round(r10*10)))]
             og["EXACT_RATING"] = [f"{r10:.2f}"]
             og["FMPS_RATING"] = [f"{r10/10.0:.3f}"]
-        if comment_text:
+        for c in comments:
             prev = og.get("comment", [None])[0]
-            og["comment"] = [append_comment(prev, comment_text)]
-        og.save()
+            og["comment"] = [append_comment(prev, c)]
+        saved = save_tags(og, path, phases)
+        return written(og.get("comment", [None])[0] or og.get("description", [None])[0], saved)
 
     elif ext == ".m4a":
         mp = MP4(path)
@@ -390,27 +603,28 @@ def write_rating(path: str, r10: float | None, comment_text: str | None):
         else:
             mp.tags["----:com.apple.iTunes:EXACT_RATING"] = [MP4FreeForm(f"{r10:.2f}".encode("utf-8"))]
             mp.tags["----:com.apple.iTunes:RATE10"] = [MP4FreeForm(f"{int(round(r10*10))}".encode("utf-8"))]
-        if comment_text:
+        for c in comments:
             prev = mp.tags.get("\xa9cmt", [""])[0]
-            mp.tags["\xa9cmt"] = [append_comment(prev, comment_text)]
-        mp.save()
+            mp.tags["\xa9cmt"] = [append_comment(prev, c)]
+        saved = save_tags(mp, path, phases)
+        return written((mp.tags.get("\xa9cmt", [None]) or [None])[0], saved)
 
     elif ext == ".wav":
         w = WAVE(path)
-        try:
-            tags = w.tags
-            if tags is None: tags = ID3(); w.tags = tags
-            if is_noneish(r10):
-                tags.delall("POPM")
-                tags.delall("TXXX:EXACT_RATING")
-            else:
-                pop = int(round((r10/10.0)*255))
-                tags.delall("POPM"); tags.add(POPM(email="TuneRater@local", rating=pop, count=0))
-                tags.delall("TXXX:EXACT_RATING"); tags.add(TXXX(encoding=3, desc="EXACT_RATING", text=[f"{r10:.2f}"]))
-            if comment_text: tags.add(COMM(encoding=3, lang="eng", desc="", text=ensure_emoji_safe(comment_text)))
-            w.save()
-        except Exception:
-            pass
+        tags = w.tags
+        if tags is None: tags = ID3(); w.tags = tags
+        if is_noneish(r10):
+            tags.delall("POPM")
+            tags.delall("TXXX:EXACT_RATING")
+        else:
+            pop = int(round((r10/10.0)*255))
+            tags.delall("POPM"); tags.add(POPM(email="TuneRater@local", rating=pop, count=0))
+            tags.delall("TXXX:EXACT_RATING"); tags.add(TXXX(encoding=3, desc="EXACT_RATING", text=[f"{r10:.2f}"]))
+        if comments: tags.setall("COMM::eng", [COMM(encoding=3, lang="eng", desc="", text=ensure_emoji_safe(comments[-1]))])
+        saved = save_tags(w, path, phases)
+        return written(id3_comment(tags), saved)
+
+    raise ValueError(f"Ratings cannot be saved to {ext or 'these'} files")
 
 def fallback_cover(size=512):
     img = Image.new("RGB", (size, size), THEME["panel2"])
@@ -421,8 +635,8 @@ def fallback_cover(size=512):
     bio = io.BytesIO(); img.save(bio, format="PNG"); bio.seek(0)
     return bio.getvalue(), "image/png"
 
-def extract_cover_bytes(path: str):
-    m = read_meta(path)
+def extract_cover_bytes(path: str, meta: dict | None = None):
+    m = meta or read_meta(path)
     if m["cover"][0]:
         return m["cover"]
     for name in ("cover.jpg","folder.jpg","cover.png","Folder.jpg"):
@@ -447,8 +661,657 @@ def safe_filename(name: str) -> str:
     if not name:
         name = "card.png"
     return name
-  
+
+def track_entry(path: str, meta: dict, mtime: int) -> dict:
+    fname = os.path.splitext(os.path.basename(path))[0]
+
+    title = meta.get("title") or ""
+    if title.strip() == "" or title.strip().lower() == "unknown title":
+        title = fname
+
+    artist = meta.get("artist") or ""
+    if artist.strip().lower() == "unknown artist":
+        artist = ""
+
+    album = (meta.get("album") or "").strip()
+    track_no = meta.get("track_no")
+    disc_no = meta.get("disc_no")
+
+    return {
+        "id": tid_for(path),
+        "title": meta["title"],
+        "artist": meta["artist"],
+        "album": album,
+        "display_title": title,
+        "display_artist": artist,
+        "duration": meta["duration"],
+        "rating_exact": meta["rating_exact"],
+        "rating_stars": meta["rating_stars"],
+        "comment": meta["comment"],
+        "track_no": (int(track_no) if isinstance(track_no, int) else None),
+        "disc_no": (int(disc_no) if isinstance(disc_no, int) else None),
+        "mtime": mtime,
+        "media_v": mtime,
+        "card_v": card_version(mtime, meta["rating_exact"], meta["comment"])
+    }
+
+def card_version(mtime: int, rating, comment) -> str:
+    return hashlib.sha1(f"{mtime}|{rating}|{comment}".encode("utf-8", "replace")).hexdigest()[:12]
+
+def scan_stats(root: str) -> dict:
+    out = {}
+    if not root or not os.path.isdir(root): return out
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        try: it = os.scandir(d)
+        except OSError: continue
+        with it:
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=True):
+                        stack.append(e.path)
+                    elif os.path.splitext(e.name)[1].lower() in ALLOWED:
+                        st = e.stat()
+                        out[e.path] = (st.st_mtime_ns, st.st_size)
+                except OSError:
+                    pass
+    return out
+
+CATALOG = {"root": None, "tracks": {}, "stats": {}, "ids": {}, "scanned": False, "order": None, "keys": None, "order_ids": None, "pos": None, "gen": 0}
+CATALOG_EPOCH = uuid.uuid4().hex[:8]
+INDEX_LOCK = threading.RLock()
+INDEX_DB = threading.local()
+INDEX_SCHEMA_LOCK = threading.Lock()
+INDEX_SCHEMA = {"ready": False}
+
+def index_db():
+    db = getattr(INDEX_DB, "conn", None)
+    if db is None:
+        with INDEX_SCHEMA_LOCK:
+            db = sqlite3.connect(INDEX_PATH, timeout=30)
+            if not INDEX_SCHEMA["ready"]:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, root TEXT NOT NULL, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, entry TEXT NOT NULL)")
+                db.execute("CREATE INDEX IF NOT EXISTS tracks_root ON tracks(root)")
+                db.execute("CREATE TABLE IF NOT EXISTS covers (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, hash TEXT NOT NULL)")
+                db.execute("CREATE TABLE IF NOT EXISTS sidecar (path TEXT PRIMARY KEY, size INTEGER NOT NULL, phash TEXT NOT NULL, rating REAL, comments TEXT NOT NULL, base TEXT, rev INTEGER NOT NULL, updated REAL NOT NULL)")
+                db.commit()
+                INDEX_SCHEMA["ready"] = True
+            db.execute("PRAGMA synchronous=NORMAL")
+        INDEX_DB.conn = db
+    return db
+
+def load_catalog(root: str):
+    tracks, stats = {}, {}
+    try:
+        for p, mt, sz, entry in index_db().execute("SELECT path, mtime_ns, size, entry FROM tracks WHERE root = ?", (root,)):
+            try: tracks[p] = json.loads(entry)
+            except: continue
+            stats[p] = (mt, sz)
+    except sqlite3.Error:
+        app.logger.exception("Failed to load track index")
+    ids = {e["id"]: p for p, e in tracks.items()}
+    with INDEX_LOCK:
+        if CATALOG["root"] == root: return
+        CATALOG.update(root=root, tracks=tracks, stats=stats, ids=ids, scanned=False, order=None, keys=None, order_ids=None, pos=None, gen=CATALOG["gen"] + 1)
+        search_rebuild(tracks.values())
+
+def _sync_paths(root: str, current: dict, removed: list):
+    with INDEX_LOCK:
+        if CATALOG["root"] != root: return
+        stats = CATALOG["stats"]
+        before = {p: stats.get(p) for p, st in current.items() if stats.get(p) != st}
+        gone = {p: stats[p] for p in removed if p in stats}
+    if current:
+        count("rately_cache_requests_total", len(current) - len(before), cache="track_index", result="hit")
+        count("rately_cache_requests_total", len(before), cache="track_index", result="miss")
+    if gone: _apply_sync(root, current, before, [], gone)
+    if not before: return
+
+    batch = []
+    for item in extract_meta(list(before)):
+        batch.append(item)
+        if len(batch) >= SCAN_APPLY_BATCH:
+            _apply_sync(root, current, before, batch, {})
+            batch = []
+    if batch: _apply_sync(root, current, before, batch, {})
+
+def _apply_sync(root: str, current: dict, before: dict, results: list, gone: dict):
+    rows, upserts, removed = [], [], []
+    with INDEX_LOCK:
+        if CATALOG["root"] != root: return
+        tracks, stats, ids = CATALOG["tracks"], CATALOG["stats"], CATALOG["ids"]
+        for p, meta in results:
+            if stats.get(p) != before[p]: continue
+            mt, sz = current[p]
+            entry = track_entry(p, meta, int(mt // 1_000_000_000))
+            tracks[p] = entry; stats[p] = (mt, sz); ids[entry["id"]] = p
+            rows.append((p, root, mt, sz, json.dumps(entry)))
+            upserts.append(entry)
+        for p, st in gone.items():
+            if stats.get(p) != st: continue
+            tracks.pop(p, None); stats.pop(p, None); ids.pop(tid_for(p), None)
+            removed.append(p)
+        if not upserts and not removed: return
+        CATALOG["order"] = CATALOG["keys"] = CATALOG["order_ids"] = CATALOG["pos"] = None
+        CATALOG["gen"] += 1
+        search_sync(upserts, [tid_for(p) for p in removed])
+
+        try:
+            db = index_db()
+            with db:
+                db.executemany("DELETE FROM tracks WHERE path = ?", [(p,) for p in removed])
+                db.executemany("INSERT OR REPLACE INTO tracks (path, root, mtime_ns, size, entry) VALUES (?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error:
+            app.logger.exception("Failed to update track index")
+
+    publish_event({"type": "changes", "upsert": upserts, "remove": [tid_for(p) for p in removed]})
+
+SCAN_PROGRESS = {"running": False, "done": 0, "total": 0}
+SCAN_LOCK = threading.Lock()
+SCAN_APPLY_BATCH = 256
+PARALLEL_SCAN_MIN = 64
+
+def _scan_meta(path: str) -> dict:
+    meta = read_meta(path, covers=False)
+    meta.pop("cover", None)
+    return meta
+
+def scan_executor():
+    workers = int(CONFIG.get("scan_workers") or max(1, (os.cpu_count() or 2) - 1))
+    if (CONFIG.get("scan_pool") or "process") == "thread":
+        return ThreadPoolExecutor(max_workers=workers), workers
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")), workers
+
+def extract_meta(paths: list):
+    SCAN_PROGRESS.update(running=True, done=0, total=len(paths))
+    try:
+        if len(paths) < PARALLEL_SCAN_MIN:
+            for p in paths:
+                yield p, _scan_meta(p)
+                SCAN_PROGRESS["done"] += 1
+            return
+
+        ex, workers = scan_executor()
+        with ex:
+            pending = deque()
+            it = iter(paths)
+
+            def submit():
+                for p in it:
+                    try: pending.append((p, ex.submit(_scan_meta, p)))
+                    except Exception: pending.append((p, None))
+                    return
+
+            for _ in range(workers * 4): submit()
+            while pending:
+                p, fut = pending.popleft()
+                try: meta = fut.result() if fut else _scan_meta(p)
+                except Exception: meta = _scan_meta(p)
+                submit()
+                yield p, meta
+                SCAN_PROGRESS["done"] += 1
+    finally:
+        SCAN_PROGRESS["running"] = False
+
+def refresh_catalog(root: str) -> dict:
+    if not root or not os.path.isdir(root): return {}
+    with SCAN_LOCK:
+        current = scan_stats(root)
+        if CATALOG["root"] != root:
+            load_catalog(root)
+        with INDEX_LOCK:
+            removed = [p for p in CATALOG["stats"] if p not in current]
+        _sync_paths(root, current, removed)
+        with INDEX_LOCK:
+            if CATALOG["root"] == root: CATALOG["scanned"] = True
+            return CATALOG["tracks"]
+
+SCAN_JOB = {"root": None, "thread": None}
+SCAN_JOB_LOCK = threading.Lock()
+
+def _scan_job(root: str):
+    try: refresh_catalog(root)
+    except Exception: app.logger.exception("Library scan failed")
+
+def start_scan(root: str) -> threading.Thread:
+    with SCAN_JOB_LOCK:
+        t = SCAN_JOB["thread"]
+        if t and t.is_alive() and SCAN_JOB["root"] == root: return t
+        t = threading.Thread(target=_scan_job, args=(root,), daemon=True)
+        SCAN_JOB.update(root=root, thread=t)
+        t.start()
+        return t
+
+def update_paths(root: str, paths):
+    current, removed = {}, []
+    for p in paths:
+        if os.path.splitext(p)[1].lower() not in ALLOWED: continue
+        try:
+            st = os.stat(p)
+            current[p] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            removed.append(p)
+    if not root or CATALOG["root"] != root: return
+    with SCAN_LOCK:
+        _sync_paths(root, current, removed)
+
+def write_through(root: str, written: dict) -> list:
+    stale, upserts, rows = [], [], []
+    with INDEX_LOCK:
+        if not root or CATALOG["root"] != root: return list(written)
+        for p, values in written.items():
+            entry = CATALOG["tracks"].get(p)
+            try: st = os.stat(p)
+            except OSError: st = None
+            if entry is None or st is None or values is None:
+                stale.append(p)
+                continue
+            r = values["rating_exact"]
+            entry = dict(entry,
+                rating_exact=r,
+                rating_stars=(round(max(0, min(5, r)) / 2, 2) if r is not None else None),
+                comment=values["comment"],
+                mtime=int(st.st_mtime_ns // 1_000_000_000),
+                media_v=entry.get("media_v", entry["mtime"]),
+            )
+            if values.get("resized"): entry["media_v"] = entry["mtime"]
+            entry["card_v"] = card_version(entry["mtime"], r, entry["comment"])
+            CATALOG["tracks"][p] = entry
+            i = (CATALOG["pos"] or {}).get(entry["id"])
+            if i is not None: CATALOG["order"][i] = entry
+            old = CATALOG["stats"].get(p)
+            CATALOG["stats"][p] = (st.st_mtime_ns, st.st_size)
+            src = COVER_SOURCES.get(p)
+            if src and old and src[0] == old: remember_cover_source(p, st, src[1])
+            rows.append((p, root, st.st_mtime_ns, st.st_size, json.dumps(entry)))
+            upserts.append(entry)
+        if upserts:
+            CATALOG["gen"] += 1
+            search_sync(upserts, [])
+            try:
+                db = index_db()
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO tracks (path, root, mtime_ns, size, entry) VALUES (?, ?, ?, ?, ?)", rows)
+            except sqlite3.Error:
+                app.logger.exception("Failed to update track index")
+    if upserts: publish_event({"type": "changes", "upsert": upserts, "remove": []})
+    return stale
+
+def media_version(path: str, st) -> int:
+    t = CATALOG["tracks"].get(path)
+    if t and CATALOG["stats"].get(path) == (st.st_mtime_ns, st.st_size):
+        return t.get("media_v", t["mtime"])
+    return int(st.st_mtime)
+
+def forget_paths(paths):
+    _sync_paths(CATALOG["root"], {}, list(paths))
+
+def track_sort_key(t):
+    alb_key = (t["album"].lower() if t["album"] else "\uffff")
+    disc_key = (t["disc_no"] if isinstance(t["disc_no"], int) else 10**9)
+    trk_key = (t["track_no"] if isinstance(t["track_no"], int) else 10**9)
+    fallback = (t["display_title"] or t["title"] or "").lower()
+    return (alb_key, disc_key, trk_key, fallback, t["id"])
+
+def ensure_catalog(root: str):
+    if not watcher_live(root): start_scan(root).join()
+
+def sorted_tracks():
+    with INDEX_LOCK:
+        if CATALOG["order"] is None:
+            order = sorted(CATALOG["tracks"].values(), key=track_sort_key)
+            CATALOG["order"], CATALOG["keys"] = order, [track_sort_key(t) for t in order]
+            CATALOG["order_ids"] = [t["id"] for t in order]
+            CATALOG["pos"] = {tid: i for i, tid in enumerate(CATALOG["order_ids"])}
+        return CATALOG["order"], CATALOG["keys"]
+
+def catalog_order(root: str) -> tuple:
+    ensure_catalog(root)
+    with INDEX_LOCK:
+        sorted_tracks()
+        return CATALOG["order_ids"], CATALOG["pos"]
+
+SEARCH = {"flat": {}, "words": {}, "tri": defaultdict(set), "bi": defaultdict(set), "short": set(), "initial": defaultdict(set), "vocab": defaultdict(set),
+          "vtri": defaultdict(set), "ratings": {}, "rated": set(), "unrated": set(), "rvals": [], "rids": [], "views": {}}
+SEARCH_LOCK = threading.RLock()
+SEARCH_VIEWS_MAX = 16
+FUZZY_BELOW = 25
+FUZZY_CANDIDATES = 64
+_search_split = re.compile(r"[^a-z0-9]+")
+_rated_re = re.compile(r"#([!-])?\s*rated\b", re.I)
+_rating_re = re.compile(r"#([!-])?\s*rating\s*:\s*([0-9]+(?:\.[0-9]+)?)(?:\s*-\s*([0-9]+(?:\.[0-9]+)?))?", re.I)
+_inline_rating_re = re.compile(r"rating\s*:\s*([<>]=?|)(\d+(?:\.\d+)?)(?:\s*-\s*(\d+(?:\.\d+)?))?", re.I)
+
+def search_words(s: str) -> list:
+    s = unicodedata.normalize("NFKD", s or "").lower()
+    s = "".join(c for c in s if not unicodedata.combining(c))
+    return [w for w in _search_split.split(s) if w]
+
+def trigrams(s: str) -> set:
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+def word_trigrams(w: str) -> set:
+    return trigrams(f" {w} ")
+
+def levenshtein(a: str, b: str) -> int:
+    if not a: return len(b)
+    if not b: return len(a)
+    dp = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        prev, dp[0] = dp[0], i
+        for j in range(1, len(b) + 1):
+            tmp = dp[j]
+            dp[j] = prev if a[i-1] == b[j-1] else 1 + min(prev, dp[j], dp[j-1])
+            prev = tmp
+    return dp[-1]
+
+def _rating_slot(tid: str, r: float) -> int:
+    vals = SEARCH["rvals"]
+    return bisect.bisect_left(SEARCH["rids"], tid, bisect.bisect_left(vals, r), bisect.bisect_right(vals, r))
+
+def _search_remove(tid: str):
+    flat = SEARCH["flat"].pop(tid, None)
+    if flat is None: return
+    for gram in trigrams(flat):
+        post = SEARCH["tri"].get(gram)
+        if post is not None:
+            post.discard(tid)
+            if not post:
+                del SEARCH["tri"][gram]
+                for bi in (gram[:2], gram[1:]):
+                    grams = SEARCH["bi"].get(bi)
+                    if grams is not None:
+                        grams.discard(gram)
+                        if not grams: del SEARCH["bi"][bi]
+    SEARCH["short"].discard(tid)
+    for w in SEARCH["words"].pop(tid, ()):
+        SEARCH["initial"][w[0]].discard(tid)
+        post = SEARCH["vocab"].get(w)
+        if post is not None:
+            post.discard(tid)
+            if not post:
+                del SEARCH["vocab"][w]
+                for gram in word_trigrams(w):
+                    ws = SEARCH["vtri"].get(gram)
+                    if ws is not None:
+                        ws.discard(w)
+                        if not ws: del SEARCH["vtri"][gram]
+    r = SEARCH["ratings"].pop(tid, None)
+    if r is None:
+        SEARCH["unrated"].discard(tid)
+        return
+    SEARCH["rated"].discard(tid)
+    i = _rating_slot(tid, r)
+    if i < len(SEARCH["rids"]) and SEARCH["rids"][i] == tid:
+        del SEARCH["rvals"][i], SEARCH["rids"][i]
+
+def _search_add(t: dict, ranked: bool = True):
+    tid = t["id"]
+    words = search_words(f'{t.get("display_title") or t.get("title") or ""} {t.get("display_artist") or t.get("artist") or ""}')
+    flat = "".join(words)
+    SEARCH["flat"][tid] = flat
+    SEARCH["words"][tid] = set(words)
+    for gram in trigrams(flat):
+        post = SEARCH["tri"][gram]
+        if not post:
+            SEARCH["bi"][gram[:2]].add(gram)
+            SEARCH["bi"][gram[1:]].add(gram)
+        post.add(tid)
+    if len(flat) < 3: SEARCH["short"].add(tid)
+    for w in set(words):
+        SEARCH["initial"][w[0]].add(tid)
+        if w not in SEARCH["vocab"]:
+            for gram in word_trigrams(w):
+                SEARCH["vtri"][gram].add(w)
+        SEARCH["vocab"][w].add(tid)
+    if t.get("rating_exact") is None:
+        SEARCH["unrated"].add(tid)
+        return
+    r = SEARCH["ratings"][tid] = float(t["rating_exact"])
+    SEARCH["rated"].add(tid)
+    if ranked:
+        i = _rating_slot(tid, r)
+        SEARCH["rvals"].insert(i, r)
+        SEARCH["rids"].insert(i, tid)
+
+def search_sync(upserts, removed):
+    with SEARCH_LOCK:
+        for tid in removed: _search_remove(tid)
+        for t in upserts:
+            _search_remove(t["id"])
+            _search_add(t)
+        SEARCH["views"] = {}
+
+def search_rebuild(tracks):
+    with SEARCH_LOCK:
+        SEARCH.update(flat={}, words={}, tri=defaultdict(set), bi=defaultdict(set), short=set(), initial=defaultdict(set), vocab=defaultdict(set),
+                      vtri=defaultdict(set), ratings={}, rated=set(), unrated=set(), views={})
+        for t in tracks: _search_add(t, ranked=False)
+        pairs = sorted((r, tid) for tid, r in SEARCH["ratings"].items())
+        SEARCH.update(rvals=[r for r, _ in pairs], rids=[tid for _, tid in pairs])
+
+def parse_query(q: str) -> dict:
+    text = q or ""
+    rated, rated_invert, rating = None, False, None
+
+    m = _rated_re.search(text)
+    if m:
+        rated, rated_invert = True, m.group(1) in ("!", "-")
+        text = text.replace(m.group(0), " ", 1)
+
+    m = _rating_re.search(text)
+    if m:
+        a = float(m.group(2)); b = float(m.group(3)) if m.group(3) is not None else a
+        rating = {"min": min(a, b), "max": max(a, b), "invert": m.group(1) in ("!", "-")}
+        text = text.replace(m.group(0), " ", 1)
+    else:
+        m = _inline_rating_re.search(text)
+        if m:
+            a = float(m.group(2)); b = float(m.group(3)) if m.group(3) else None
+            if b is not None:
+                rating = {"min": min(a, b), "max": max(a, b), "invert": False}
+            elif ">" in m.group(1):
+                rating = {"gt": a, "invert": False}
+            elif "<" in m.group(1):
+                rating = {"lt": a, "invert": False}
+            else:
+                rating = {"min": a, "max": None, "invert": False}
+            text = text.replace(m.group(0), " ", 1)
+
+    return {"words": search_words(text), "rated": rated, "rated_invert": rated_invert, "rating": rating}
+
+def _rating_ids(filt: dict) -> set:
+    vals, ids = SEARCH["rvals"], SEARCH["rids"]
+    if "gt" in filt: lo, hi = bisect.bisect_right(vals, filt["gt"]), len(vals)
+    elif "lt" in filt: lo, hi = 0, bisect.bisect_left(vals, filt["lt"])
+    else:
+        lo = bisect.bisect_left(vals, filt["min"])
+        hi = bisect.bisect_right(vals, filt["max"]) if filt["max"] is not None else len(vals)
+    return set(ids[lo:hi])
+
+def _token_hits(tok: str, scope):
+    flat = SEARCH["flat"]
+    if len(tok) < 2:
+        sub = set(SEARCH["initial"].get(tok, ()))
+        if scope is not None: sub &= scope
+    elif len(tok) >= 3:
+        sub = None if scope is None or len(scope) > 2000 else set(scope)
+        for gram in sorted(trigrams(tok), key=lambda gram: len(SEARCH["tri"].get(gram, ()))):
+            post = SEARCH["tri"].get(gram)
+            if not post: sub = set(); break
+            sub = set(post) if sub is None else (sub & post)
+            if not sub: break
+        if scope is not None: sub &= scope
+        if len(tok) > 3: sub = {tid for tid in sub if tok in flat[tid]}
+    elif scope is not None and len(scope) <= 2000:
+        sub = {tid for tid in scope if tok in flat[tid]}
+    else:
+        sub = {tid for tid in SEARCH["short"] if tok in flat[tid]}
+        for gram in SEARCH["bi"].get(tok, ()): sub |= SEARCH["tri"][gram]
+        if scope is not None: sub &= scope
+
+    exact = SEARCH["vocab"].get(tok, set()) & sub
+    fuzzy = set()
+    if len(tok) >= 4 and len(sub) < FUZZY_BELOW:
+        th = max(1, -(-len(tok) * 3 // 10))
+        grams = word_trigrams(tok)
+        shared = defaultdict(int)
+        for gram in grams:
+            for w in SEARCH["vtri"].get(gram, ()):
+                shared[w] += 1
+        need = max(1, len(grams) - 3 * th)
+        close = [w for w, n in shared.items() if n >= need and abs(len(w) - len(tok)) <= th]
+        close.sort(key=shared.__getitem__, reverse=True)
+        for w in close[:FUZZY_CANDIDATES]:
+            if levenshtein(tok, w) <= th:
+                fuzzy |= SEARCH["vocab"][w]
+        if scope is not None: fuzzy &= scope
+        fuzzy -= sub
+    return exact, sub, fuzzy
+
+def in_order(ids, order: list, pos: dict) -> list:
+    if len(ids) * 5 < len(order): return sorted(filter(pos.__contains__, ids), key=pos.__getitem__)
+    return list(filter(ids.__contains__, order))
+
+def search_tracks(q: str, order: list | None = None, pos: dict | None = None) -> list:
+    pq = parse_query(q)
+    if order is None: order, pos = CATALOG["order_ids"] or [], CATALOG["pos"] or {}
+    view = None
+    if not pq["words"]:
+        rating = pq["rating"] and tuple(sorted(pq["rating"].items()))
+        view = (pq["rated"], pq["rated_invert"], rating)
+    with SEARCH_LOCK:
+        cached = SEARCH["views"].get(view)
+        if cached and cached[0] is order: return list(cached[1])
+        scope = None
+        if pq["rated"]:
+            scope = SEARCH["unrated"] if pq["rated_invert"] else SEARCH["rated"]
+        if pq["rating"]:
+            hit = _rating_ids(pq["rating"])
+            if pq["rating"]["invert"]: hit = SEARCH["flat"].keys() - hit
+            scope = hit if scope is None else (scope & hit)
+
+        exact_all, fuzzed = None, set()
+        for tok in sorted(set(pq["words"]), key=len, reverse=True):
+            exact, sub, fuzzy = _token_hits(tok, scope)
+            exact_all = exact if exact_all is None else (exact_all & exact)
+            fuzzed |= fuzzy
+            scope = (sub | fuzzy) if fuzzy else sub
+            if not scope: break
+
+        if scope is None: return list(order)
+        ids = in_order(scope, order, pos)
+        if view is not None:
+            if len(SEARCH["views"]) >= SEARCH_VIEWS_MAX: SEARCH["views"] = {}
+            SEARCH["views"][view] = (order, ids)
+            return list(ids)
+    if exact_all is None: return ids
+    rest = list(filterfalse(exact_all.__contains__, ids))
+    if fuzzed: rest = list(filterfalse(fuzzed.__contains__, rest)) + list(filter(fuzzed.__contains__, rest))
+    return list(filter(exact_all.__contains__, ids)) + rest
+
+EVENT_SUBSCRIBERS = set()
+EVENT_HOOKS = []
+EVENT_LOCK = threading.Lock()
+EVENT_COND = threading.Condition(EVENT_LOCK)
+EVENT_LOG = deque(maxlen=512)
+EVENT_STATE = {"seq": 0}
+EVENT_HOLD = 15
+EVENT_HOLDS = threading.BoundedSemaphore(4)
+
+def publish_event(ev: dict):
+    with EVENT_LOCK:
+        EVENT_STATE["seq"] += 1
+        EVENT_LOG.append((EVENT_STATE["seq"], ev))
+        subs, hooks = list(EVENT_SUBSCRIBERS), list(EVENT_HOOKS)
+        EVENT_COND.notify_all()
+    for hook in hooks: hook()
+    for q in subs:
+        try:
+            q.put_nowait(ev)
+        except queue.Full:
+            with q.mutex: q.queue.clear()
+            q.put_nowait({"type": "reload"})
+
+WATCHER = {"root": None, "stop": None, "thread": None, "mode": None}
+WATCHER_LOCK = threading.Lock()
+
+def _watch_loop(root, stop):
+    interval = float(CONFIG.get("watch_interval") or 5)
+    rescan = float(CONFIG.get("watch_rescan") or 300)
+    last_full = time.monotonic()
+    dirty, full = set(), [False]
+    wake = threading.Event()
+    observer = None
+
+    if WATCHDOG_OK:
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, ev):
+                if ev.event_type in ("opened", "closed_no_write"): return
+                if ev.is_directory: full[0] = True
+                else:
+                    dirty.add(ev.src_path)
+                    if getattr(ev, "dest_path", None): dirty.add(ev.dest_path)
+                wake.set()
+        try:
+            observer = Observer()
+            observer.schedule(Handler(), root, recursive=True)
+            observer.start()
+            WATCHER["mode"] = "native"
+        except Exception:
+            app.logger.exception("Native file watcher unavailable, polling instead")
+            observer = None
+    if observer is None:
+        WATCHER["mode"] = "poll"
+
+    try:
+        while not stop.is_set():
+            if observer is None:
+                if stop.wait(interval): break
+                if CONFIG.get("library") == root: refresh_catalog(root)
+                continue
+            wake.wait(min(interval * 12, rescan))
+            if stop.is_set(): break
+            if not wake.is_set():
+                if CONFIG.get("library") == root and time.monotonic() - last_full >= rescan:
+                    refresh_catalog(root)
+                    last_full = time.monotonic()
+                continue
+            stop.wait(0.5)
+            wake.clear()
+            batch = list(dirty); dirty.clear()
+            if CONFIG.get("library") != root: continue
+            if full[0]:
+                full[0] = False
+                refresh_catalog(root)
+                last_full = time.monotonic()
+            elif batch:
+                update_paths(root, batch)
+    except Exception:
+        app.logger.exception("Library watcher stopped")
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join(timeout=2)
+
+def ensure_watcher(root: str):
+    with WATCHER_LOCK:
+        if WATCHER["root"] == root and WATCHER["thread"] and WATCHER["thread"].is_alive(): return
+        if WATCHER["stop"]: WATCHER["stop"].set()
+        WATCHER.update(root=None, stop=None, thread=None, mode=None)
+        if not root or not os.path.isdir(root): return
+        stop = threading.Event()
+        t = threading.Thread(target=_watch_loop, args=(root, stop), daemon=True)
+        WATCHER.update(root=root, stop=stop, thread=t)
+        t.start()
+
+def watcher_live(root: str) -> bool:
+    return bool(WATCHER["root"] == root and WATCHER["thread"] and WATCHER["thread"].is_alive() and CATALOG["root"] == root and CATALOG["scanned"])
+
 PICK_JOBS = {}
+PICK_LOCK = threading.Lock()
 
 def askdir(root):
     global forcedpath
@@ -474,16 +1337,139 @@ def _start_pick_job(job_id):
             else: out["canceled"] = True
     except Exception:
         out["canceled"] = True
-    PICK_JOBS[job_id] = out
+    with PICK_LOCK: PICK_JOBS[job_id] = out
 
 @app.route("/health", methods=["GET", "POST"])
 def health():
     return ("", 200)
 
+PROFILE_DIR = os.path.join(os.path.dirname(CONFIG_PATH), "profiles")
+PROFILE_KEEP = int(CONFIG.get("profile_keep") or 50)
+PROFILE_LOCK = threading.Lock()
+
+def profile_threshold_ms() -> float | None:
+    v = os.environ.get("RATELY_PROFILE_MS") or CONFIG.get("profile_slow_ms")
+    try: return float(v) if v not in (None, "", False) else None
+    except (TypeError, ValueError): return None
+
+def save_profile(prof: cProfile.Profile, ms: float, route: str, tid: str | None) -> str | None:
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(ms)}ms-{slug}" + (f"-{re.sub(r'[^A-Za-z0-9_-]', '', tid)}" if tid else "") + ".pstats"
+    with PROFILE_LOCK:
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            prof.dump_stats(os.path.join(PROFILE_DIR, name))
+            old = sorted(e for e in os.listdir(PROFILE_DIR) if e.endswith(".pstats"))
+            for victim in old[:max(0, len(old) - PROFILE_KEEP)]:
+                try: os.remove(os.path.join(PROFILE_DIR, victim))
+                except OSError: pass
+        except OSError:
+            app.logger.exception("Failed to save request profile")
+            return None
+    return name
+
+@app.before_request
+def _request_timer():
+    g.request_t0 = time.perf_counter()
+    if profile_threshold_ms() is not None and request.endpoint not in ("api_profiles", "api_profile"):
+        prof = cProfile.Profile()
+        try: prof.enable()
+        except ValueError: return
+        g.request_profile = prof
+
+@app.after_request
+def _request_metrics(resp):
+    t0 = g.get("request_t0")
+    if t0 is None: return resp
+    prof = g.get("request_profile")
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    method, status = request.method, str(resp.status_code)
+    tid = (request.view_args or {}).get("tid")
+    def done():
+        took = time.perf_counter() - t0
+        observe("rately_request_seconds", took, route=route, method=method)
+        count("rately_requests_total", route=route, method=method, status=status)
+        if prof is not None:
+            prof.disable()
+            limit = profile_threshold_ms()
+            if limit is not None and took * 1000 >= limit: save_profile(prof, took * 1000, route, tid)
+    if resp.direct_passthrough: done()
+    else: resp.call_on_close(done)
+    return resp
+
+def profile_list() -> list:
+    out = []
+    try: names = sorted((e for e in os.listdir(PROFILE_DIR) if e.endswith(".pstats")), reverse=True)
+    except OSError: names = []
+    for name in names:
+        m = re.match(r"^(\d{8}-\d{6})-(\d+)ms-([A-Za-z0-9_]+)(?:-([A-Za-z0-9_-]+))?\.pstats$", name)
+        try: size = os.path.getsize(os.path.join(PROFILE_DIR, name))
+        except OSError: continue
+        out.append({"name": name, "size": size, "created": m.group(1) if m else None, "ms": int(m.group(2)) if m else None, "route": m.group(3) if m else None, "tid": m.group(4) if m else None})
+    return out
+
+@app.get("/api/profiles")
+def api_profiles():
+    return jsonify(ok=True, enabled=profile_threshold_ms() is not None, threshold_ms=profile_threshold_ms(), dir=PROFILE_DIR, profiles=profile_list())
+
+@app.get("/api/profiles/<name>")
+def api_profile(name):
+    if name not in {p["name"] for p in profile_list()}: return abort(404)
+    fn = os.path.join(PROFILE_DIR, name)
+    if request.args.get("format") == "text":
+        bio = io.StringIO()
+        try:
+            st = pstats.Stats(fn, stream=bio)
+            st.sort_stats(request.args.get("sort") or "cumulative").print_stats(int(request.args.get("limit") or 60))
+        except Exception as e:
+            return jsonify(ok=False, error=str(e)), 400
+        return Response(bio.getvalue(), mimetype="text/plain")
+    return send_file(fn, mimetype="application/octet-stream", as_attachment=True, download_name=name)
+
+def _label_value(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(items) -> str:
+    return "{" + ",".join(f'{k}="{_label_value(v)}"' for k, v in items) + "}" if items else ""
+
+def metrics_text() -> str:
+    with METRICS_LOCK:
+        hists = {k: (list(v[0]), v[1]) for k, v in METRICS["hist"].items()}
+        counts = dict(METRICS["count"])
+    for name, fn in (("font", font_at), ("text_width", text_width), ("rounded_mask", rounded_mask)):
+        info = fn.cache_info()
+        counts[("rately_cache_requests_total", (("cache", name), ("result", "hit")))] = info.hits
+        counts[("rately_cache_requests_total", (("cache", name), ("result", "miss")))] = info.misses
+    gauges = {("rately_cache_bytes", (("cache", c["name"]),)): c["bytes"] for c in (COVER_CACHE, CARD_CACHE)}
+    gauges[("rately_cache_bytes", (("cache", "cards_mem"),))] = CARD_MEM_STATE["bytes"]
+    gauges[("rately_tracks", ())] = len(CATALOG["tracks"] or {})
+    gauges[("rately_rate_pending", ())] = len(RATES["pending"]) + len(RATES["writing"])
+
+    series = defaultdict(list)
+    for (name, labels), (buckets, total) in sorted(hists.items()):
+        n = 0
+        for le, c in zip(METRIC_BUCKETS + ("+Inf",), buckets):
+            n += c
+            series[name].append(f"{name}_bucket{_labels(labels + (('le', le),))} {n}")
+        series[name].append(f"{name}_sum{_labels(labels)} {total:.6f}")
+        series[name].append(f"{name}_count{_labels(labels)} {n}")
+    for (name, labels), v in sorted(counts.items()) + sorted(gauges.items()):
+        series[name].append(f"{name}{_labels(labels)} {v}")
+
+    out = []
+    for name in sorted(series):
+        kind, text = METRIC_HELP.get(name, ("untyped", name))
+        out += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"] + series[name]
+    return "\n".join(out) + "\n"
+
+@app.get("/metrics")
+def metrics():
+    return Response(metrics_text(), mimetype="text/plain; version=0.0.4")
+
 @app.post("/pick_library_start")
 def pick_library_start():
     job_id = uuid.uuid4().hex
-    PICK_JOBS[job_id] = {"status":"pending", "path":"", "canceled": False}
+    with PICK_LOCK: PICK_JOBS[job_id] = {"status":"pending", "path":"", "canceled": False}
     t = threading.Thread(target=_start_pick_job, args=(job_id,), daemon=True)
     t.start()
     return jsonify(ok=True, job_id=job_id)
@@ -491,16 +1477,17 @@ def pick_library_start():
 @app.get("/pick_library_status")
 def pick_library_status():
     jid = request.args.get("job_id","")
-    st = PICK_JOBS.get(jid)
-    if not st:
-        return jsonify(ok=False, done=False)
+    with PICK_LOCK:
+        st = PICK_JOBS.get(jid)
+        if not st:
+            return jsonify(ok=False, done=False)
 
-    done = (st.get("status") == "done") or (st.get("path") != "" or st.get("canceled"))
-    path = st.get("path","")
-    canceled = st.get("canceled", False)
+        done = (st.get("status") == "done") or (st.get("path") != "" or st.get("canceled"))
+        path = st.get("path","")
+        canceled = st.get("canceled", False)
 
-    if done:
-        PICK_JOBS.pop(jid, None)
+        if done:
+            PICK_JOBS.pop(jid, None)
 
     return jsonify(ok=True, done=done, path=path, canceled=canceled)
 
@@ -529,88 +1516,334 @@ def set_library():
     path = (data.get("path") or "").strip().strip('"')
     if not os.path.isdir(path):
         return jsonify(ok=False, error="Folder not found")
-    CONFIG["library"] = os.path.abspath(path)
-    save_config()
-    path_for_tid.cache_clear()
-    return jsonify(ok=True, count=len(scan_files(CONFIG["library"])))
+    root = os.path.abspath(path)
+    set_config(library=root)
+    ensure_watcher(root)
+    return jsonify(ok=True, count=len(scan_files(root)))
+
+TRACKS_BODIES = OrderedDict()
+TRACKS_BODY_CAP = 16
+TRACKS_BODY_LOCK = threading.Lock()
+COMPRESS_MIN = 1024
+TRACKS_STREAM_FIRST = 200
+TRACKS_STREAM_BATCH = 2000
+
+def pick_encoding() -> str:
+    acc = request.accept_encodings
+    if BROTLI_OK and acc["br"]: return "br"
+    if acc["gzip"]: return "gzip"
+    return "identity"
+
+def encode_body(data: bytes, enc: str) -> bytes:
+    if enc == "br": return brotli.compress(data, quality=5)
+    if enc == "gzip": return gzip.compress(data, compresslevel=6, mtime=0)
+    return data
+
+def body_encoder(enc: str):
+    if enc == "br":
+        c = brotli.Compressor(quality=5)
+        return c.process, c.flush, c.finish
+    if enc == "gzip":
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+    return (lambda b: b), bytes, bytes
+
+def etag_match(etag: str) -> bool:
+    inm = request.headers.get("If-None-Match")
+    return bool(inm) and (inm.strip() == "*" or etag in [t.strip() for t in inm.split(",")])
+
+def track_fields() -> list:
+    return [f for f in (request.args.get("fields") or "").replace(" ", "").split(",") if f]
+
+def tracks_body(tracks: list, keys: list):
+    start = 0
+    cursor = request.args.get("cursor")
+    if cursor:
+        try: start = bisect.bisect_right(keys, tuple(json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))))
+        except: return None
+    limit = request.args.get("limit", type=int)
+    page = tracks[start:start + limit] if limit and limit > 0 else tracks[start:]
+    next_cursor = None
+    if page and start + len(page) < len(tracks):
+        next_cursor = b64u(json.dumps(keys[start + len(page) - 1]).encode("utf-8"))
+
+    fields = track_fields()
+    if fields:
+        page = [{k: t.get(k) for k in fields} for t in page]
+
+    if request.args.get("format") == "ndjson":
+        return (json.dumps(t, separators=(",", ":")) + "\n" for t in page), "application/x-ndjson", next_cursor
+    return json.dumps({"tracks": page, "next_cursor": next_cursor}, separators=(",", ":")).encode("utf-8"), "application/json", next_cursor
+
+def store_tracks_body(key: tuple, hit: tuple):
+    with TRACKS_BODY_LOCK:
+        for k in [k for k in TRACKS_BODIES if k[0] < key[0]]: del TRACKS_BODIES[k]
+        TRACKS_BODIES[key] = hit
+        while len(TRACKS_BODIES) > TRACKS_BODY_CAP: TRACKS_BODIES.popitem(last=False)
+
+def stream_tracks_body(lines, key: tuple, enc: str, mime: str, next_cursor):
+    compress, flush, finish = body_encoder(enc)
+    parts, batch, n = [], [], 0
+    for line in lines:
+        if line is not None:
+            batch.append(line)
+            n += 1
+            if n != TRACKS_STREAM_FIRST and len(batch) < TRACKS_STREAM_BATCH: continue
+        if not batch: continue
+        chunk = compress("".join(batch).encode("utf-8")) + flush()
+        batch = []
+        parts.append(chunk)
+        yield chunk
+    chunk = compress("".join(batch).encode("utf-8")) + finish()
+    parts.append(chunk)
+    yield chunk
+    if key is not None: store_tracks_body(key, (b"".join(parts), enc, mime, next_cursor))
+
+def cold_track_lines(root: str, fields: list):
+    q = queue.Queue()
+    with EVENT_LOCK: EVENT_SUBSCRIBERS.add(q)
+    sent = set()
+
+    def line(t):
+        sent.add(t["id"])
+        return json.dumps({k: t.get(k) for k in fields} if fields else t, separators=(",", ":")) + "\n"
+
+    try:
+        scan = start_scan(root)
+        if CATALOG["root"] != root: load_catalog(root)
+        with INDEX_LOCK:
+            cached = list(CATALOG["tracks"].items()) if CATALOG["root"] == root else []
+            stats = {p: CATALOG["stats"].get(p) for p, _ in cached}
+        current = scan_stats(root)
+        for t in sorted((t for p, t in cached if stats[p] == current.get(p)), key=track_sort_key):
+            yield line(t)
+        yield None
+        while scan.is_alive() or not q.empty():
+            try: ev = q.get(timeout=0.25)
+            except queue.Empty: continue
+            if ev.get("type") != "changes": continue
+            for t in ev["upsert"]:
+                if t["id"] not in sent: yield line(t)
+            yield None
+        with INDEX_LOCK:
+            rest = [t for t in CATALOG["tracks"].values() if t["id"] not in sent] if CATALOG["root"] == root else []
+        for t in sorted(rest, key=track_sort_key):
+            yield line(t)
+    finally:
+        with EVENT_LOCK: EVENT_SUBSCRIBERS.discard(q)
 
 @app.get("/api/tracks")
 def api_tracks():
     root = CONFIG.get("library")
-    tracks = []
-    for p in scan_files(root or ""):
-        meta = read_meta(p)
-
-        fname = os.path.splitext(os.path.basename(p))[0]
-
-        title = meta.get("title") or ""
-        if title.strip() == "" or title.strip().lower() == "unknown title":
-            title = fname
-
-        artist = meta.get("artist") or ""
-        if artist.strip().lower() == "unknown artist":
-            artist = ""
-
-        album = (meta.get("album") or "").strip()
-        track_no = meta.get("track_no")
-        disc_no = meta.get("disc_no")
-
-        tracks.append({
-            "id": tid_for(p),
-            "title": meta["title"],
-            "artist": meta["artist"],
-            "album": album,
-            "display_title": title,
-            "display_artist": artist,
-            "duration": meta["duration"],
-            "rating_exact": meta["rating_exact"],
-            "rating_stars": meta["rating_stars"],
-            "comment": meta["comment"],
-            "track_no": (int(track_no) if isinstance(track_no, int) else None),
-            "disc_no": (int(disc_no) if isinstance(disc_no, int) else None),
-            "mtime": file_mtime_epoch(p)
-        })
-
-    def sort_key(t):
-        alb_key = (t["album"].lower() if t["album"] else "\uffff")
-        disc_key = (t["disc_no"] if isinstance(t["disc_no"], int) else 10**9)
-        trk_key = (t["track_no"] if isinstance(t["track_no"], int) else 10**9)
-        fallback = (t["display_title"] or t["title"] or "").lower()
-        return (alb_key, disc_key, trk_key, fallback)
-
-    tracks.sort(key=sort_key)
-    return jsonify(tracks=tracks)
+    tracks, keys, gen = [], [], 0
+    if root:
+        ensure_watcher(root)
+        cold = not (CATALOG["root"] == root and CATALOG["scanned"])
+        if cold and request.args.get("format") == "ndjson" and not request.args.get("cursor") and not request.args.get("limit"):
+            enc = pick_encoding()
+            resp = Response(stream_tracks_body(cold_track_lines(root, track_fields()), None, enc, "application/x-ndjson", None), mimetype="application/x-ndjson")
+            if enc != "identity": resp.headers["Content-Encoding"] = enc
+            resp.headers["Cache-Control"] = "no-store"
+            resp.headers["Vary"] = "Accept-Encoding"
+            return resp
+        ensure_catalog(root)
+        with INDEX_LOCK:
+            tracks, keys = sorted_tracks()
+            tracks, gen = list(tracks), CATALOG["gen"]
+
+    query = sorted((k, v) for k, v in request.args.items(multi=True) if k in ("cursor", "limit", "fields", "format"))
+    variant = hashlib.sha1(json.dumps([root, query]).encode("utf-8")).hexdigest()[:12]
+    etag = f'W/"tracks-{CATALOG_EPOCH}-{gen}-{variant}"'
+    if etag_match(etag):
+        resp = Response(status=304)
+    else:
+        enc = pick_encoding()
+        key = (gen, etag, enc)
+        with TRACKS_BODY_LOCK:
+            hit = TRACKS_BODIES.get(key)
+            if hit is not None: TRACKS_BODIES.move_to_end(key)
+        cache_result("tracks_body", hit is not None)
+        if hit is None:
+            built = tracks_body(tracks, keys)
+            if built is None: return jsonify(ok=False, error="Bad cursor"), 400
+            data, mime, next_cursor = built
+            if isinstance(data, bytes):
+                if len(data) < COMPRESS_MIN: enc = "identity"
+                hit = (encode_body(data, enc), enc, mime, next_cursor)
+                store_tracks_body(key, hit)
+            else:
+                hit = (stream_tracks_body(data, key, enc, mime, next_cursor), enc, mime, next_cursor)
+        body, enc, mime, next_cursor = hit
+        resp = Response(body, mimetype=mime)
+        if enc != "identity": resp.headers["Content-Encoding"] = enc
+        if next_cursor: resp.headers["X-Next-Cursor"] = next_cursor
+    resp.headers["ETag"] = etag
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["Vary"] = "Accept-Encoding"
+    return resp
+
+@app.get("/api/search")
+def api_search():
+    root = CONFIG.get("library")
+    if not root: return jsonify(ids=[], total=0)
+    ensure_watcher(root)
+    ids = search_tracks(request.args.get("q", ""), *catalog_order(root))
+    limit = request.args.get("limit", type=int)
+    return jsonify(ids=ids[:limit] if limit and limit > 0 else ids, total=len(ids))
+
+@app.get("/api/scan_status")
+def api_scan_status():
+    return jsonify(**SCAN_PROGRESS)
+
+def event_frames(since) -> tuple:
+    seq = EVENT_STATE["seq"]
+    if since is None: return [], seq
+    if since < seq and (not EVENT_LOG or EVENT_LOG[0][0] > since + 1):
+        return [f"id: {CATALOG_EPOCH}-{seq}\ndata: {json.dumps({'type': 'reload'})}\n\n"], seq
+    return [f"id: {CATALOG_EPOCH}-{n}\ndata: {json.dumps(ev)}\n\n" for n, ev in EVENT_LOG if n > since], seq
+
+def last_event_seq():
+    epoch, _, n = (request.headers.get("Last-Event-ID") or "").partition("-")
+    if not epoch: return None
+    try: return int(n) if epoch == CATALOG_EPOCH else -1
+    except ValueError: return -1
+
+def event_response(frames: list, seq: int, retry: int, stream: bool = False):
+    body = f"retry: {retry}\nid: {CATALOG_EPOCH}-{seq}\n\n" + "".join(frames)
+    resp = Response(iter([body]) if stream else body, mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+@app.get("/api/events")
+def api_events():
+    since = last_event_seq()
+    hub = request.environ.get("rately.events")
+    if hub is not None and hub.reserve_feed():
+        with EVENT_LOCK: frames, seq = event_frames(since)
+        request.environ["rately.feed"] = seq
+        return event_response(frames, seq, 3000, stream=True)
+
+    with EVENT_LOCK: frames, seq = event_frames(since)
+    if frames or not EVENT_HOLDS.acquire(blocking=False):
+        return event_response(frames, seq, 3000)
+    try:
+        with EVENT_COND:
+            EVENT_COND.wait_for(lambda: EVENT_STATE["seq"] > seq, EVENT_HOLD)
+            frames, seq = event_frames(seq)
+    finally:
+        EVENT_HOLDS.release()
+    return event_response(frames, seq, 250)
+
+AUDIO_CHUNK = 256 * 1024
+MAX_RANGES = 32
+
+def parse_ranges(header: str, size: int):
+    if not header or not header.strip().lower().startswith("bytes="): return None
+    out = []
+    for part in header.split("=", 1)[1].split(","):
+        m = re.fullmatch(r"\s*(\d*)\s*-\s*(\d*)\s*", part)
+        if not m or not (m.group(1) or m.group(2)): return None
+        if m.group(1):
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            if m.group(2) and int(m.group(2)) < start: return None
+        else:
+            n = int(m.group(2))
+            if n == 0: continue
+            start, end = max(0, size - n), size - 1
+        if start < size: out.append((start, end))
+    if len(out) > MAX_RANGES: return None
+    return out
+
+def file_chunks(path: str, spans, prefix=None, suffix=b"", size=None):
+    lock = file_lock(path)
+    with open(path, "rb", buffering=0) as f:
+        for i, (start, end) in enumerate(spans):
+            if prefix: yield prefix[i]
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                with lock.read():
+                    if size is not None and os.fstat(f.fileno()).st_size != size: raise OSError(f"{path} changed size while streaming")
+                    data = f.read(min(AUDIO_CHUNK, left))
+                if not data: return
+                left -= len(data)
+                yield data
+    if suffix: yield suffix
+
+class LockedAudio:
+    def __init__(self, path: str, start: int, length: int, size: int):
+        self.path, self.end, self.size, self.lock = path, start + length, size, file_lock(path)
+        self.f = open(path, "rb", buffering=0)
+        self.f.seek(start)
+
+    def read(self, n=-1):
+        left = max(0, self.end - self.f.tell())
+        n = left if n is None or n < 0 else min(n, left)
+        with self.lock.read():
+            if os.fstat(self.f.fileno()).st_size != self.size: raise OSError(f"{self.path} changed size while streaming")
+            return self.f.read(n)
+
+    def seek(self, pos, whence=0): return self.f.seek(pos, whence)
+    def tell(self): return self.f.tell()
+    def close(self): self.f.close()
+
+def file_span_body(path: str, start: int, length: int, size: int):
+    wrapper = request.environ.get("wsgi.file_wrapper")
+    if wrapper: return wrapper(LockedAudio(path, start, length, size), AUDIO_CHUNK)
+    return file_chunks(path, [(start, start + length - 1)], size=size)
 
 @app.get("/audio/<tid>")
 def audio(tid):
     try: path = path_for_tid(tid)
     except: return abort(404)
     rng = request.headers.get("Range", None)
-    size = os.path.getsize(path)
+    with file_lock(path).read(): st = os.stat(path)
+    size = st.st_size
     mime = guess_mime(path)
 
-    ver = file_mtime_epoch(path)
+    ver = media_version(path, st)
     etag = f'W/"audio-{tid}-{ver}-{size}"'
 
     if not rng and client_conditional_hit(etag, ver):
         resp = Response(status=304)
         return set_immutable_cache(resp, etag, ver)
 
-    if rng:
-        m = re.match(r"bytes=(\d+)-(\d*)", rng or "")
-        if m:
-            start = int(m.group(1))
-            end = int(m.group(2)) if m.group(2) else size-1
-            end = min(end, size-1); length = end - start + 1
-            with open(path, "rb") as f:
-                f.seek(start); data = f.read(length)
-            rv = Response(data, 206, mimetype=mime, direct_passthrough=True)
-            rv.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
-            rv.headers["Accept-Ranges"] = "bytes"
-            rv.headers["Content-Length"] = str(length)
-            return set_immutable_cache(rv, etag, ver)
-
-    resp = send_file(path, mimetype=mime)
+    if_range = request.headers.get("If-Range")
+    if rng and if_range and if_range != etag and if_range != httpdate(ver):
+        rng = None
+
+    spans = parse_ranges(rng, size) if rng else None
+    if spans == []:
+        rv = Response(status=416)
+        rv.headers["Content-Range"] = f"bytes */{size}"
+        rv.headers["Accept-Ranges"] = "bytes"
+        return rv
+
+    if spans and len(spans) == 1:
+        start, end = spans[0]
+        length = end - start + 1
+        rv = Response(file_span_body(path, start, length, size), 206, mimetype=mime, direct_passthrough=True)
+        rv.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        rv.headers["Accept-Ranges"] = "bytes"
+        rv.headers["Content-Length"] = str(length)
+        return set_immutable_cache(rv, etag, ver)
+
+    if spans:
+        boundary = uuid.uuid4().hex
+        heads = [f"\r\n--{boundary}\r\nContent-Type: {mime}\r\nContent-Range: bytes {a}-{b}/{size}\r\n\r\n".encode() for a, b in spans]
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        length = sum(len(h) for h in heads) + sum(b - a + 1 for a, b in spans) + len(tail)
+        rv = Response(file_chunks(path, spans, heads, tail, size=size), 206, direct_passthrough=True)
+        rv.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        rv.headers["Accept-Ranges"] = "bytes"
+        rv.headers["Content-Length"] = str(length)
+        return set_immutable_cache(rv, etag, ver)
+
+    resp = Response(file_span_body(path, 0, size, size), 200, mimetype=mime, direct_passthrough=True)
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.headers["Content-Length"] = str(size)
     return set_immutable_cache(resp, etag, ver)
 
 def resize_image_bytes(data: bytes, mime: str, w: int | None) -> tuple[bytes, str]:
@@ -632,24 +1865,548 @@ def resize_image_bytes(data: bytes, mime: str, w: int | None) -> tuple[bytes, st
     except:
         return data, mime
 
+_image_exts = {"image/webp": "webp", "image/png": "png", "image/jpeg": "jpg", "image/jpg": "jpg", "image/gif": "gif", "image/bmp": "bmp"}
+_ext_mimes = {"webp": "image/webp", "png": "image/png", "jpg": "image/jpeg", "gif": "image/gif", "bmp": "image/bmp", "bin": "application/octet-stream"}
+
+def disk_cache(name: str, cap_mb: int) -> dict:
+    return {"name": name, "dir": os.path.join(CACHE_DIR, name), "cap": int(cap_mb) * 1024 * 1024, "lock": threading.Lock(), "files": None, "bytes": 0}
+
+def _disk_cache_files(c: dict) -> OrderedDict:
+    if c["files"] is None:
+        os.makedirs(c["dir"], exist_ok=True)
+        found = []
+        for e in os.scandir(c["dir"]):
+            if e.is_file() and not e.name.endswith(".tmp"):
+                st = e.stat()
+                found.append((st.st_mtime, e.name, st.st_size))
+        found.sort()
+        c["files"] = OrderedDict((name.rsplit(".", 1)[0], (name, size)) for _, name, size in found)
+        c["bytes"] = sum(size for _, _, size in found)
+    return c["files"]
+
+def disk_cache_get(c: dict, key: str):
+    with c["lock"]:
+        hit = _disk_cache_files(c).get(key)
+        if hit is None:
+            cache_result(c["name"], False)
+            return None
+        c["files"].move_to_end(key)
+    fn = os.path.join(c["dir"], hit[0])
+    try:
+        with open(fn, "rb") as f: data = f.read()
+        os.utime(fn)
+    except OSError:
+        with c["lock"]:
+            if c["files"].pop(key, None): c["bytes"] -= hit[1]
+        cache_result(c["name"], False)
+        return None
+    cache_result(c["name"], True)
+    return data, _ext_mimes.get(hit[0].rsplit(".", 1)[-1], "application/octet-stream")
+
+def disk_cache_put(c: dict, key: str, data: bytes, ext: str):
+    name = f"{key}.{ext}"
+    fn = os.path.join(c["dir"], name)
+    with c["lock"]:
+        files = _disk_cache_files(c)
+    try:
+        tmp = f"{fn}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f: f.write(data)
+        os.replace(tmp, fn)
+    except OSError:
+        app.logger.exception("Failed to write cache entry")
+        return
+    with c["lock"]:
+        old = files.pop(key, None)
+        if old: c["bytes"] -= old[1]
+        files[key] = (name, len(data)); c["bytes"] += len(data)
+        while c["bytes"] > c["cap"] and len(files) > 1:
+            _, (victim, size) = files.popitem(last=False)
+            c["bytes"] -= size
+            try: os.remove(os.path.join(c["dir"], victim))
+            except OSError: pass
+
+COVER_CACHE = disk_cache("covers", CONFIG.get("cover_cache_mb") or 512)
+COVER_BUCKETS = (64, 96, 128, 192, 256, 384, 512, 768, 1024, 1536, 2048)
+COVER_SOURCES = {}
+
+def cover_bucket(w: int) -> int:
+    w = max(32, min(2048, int(w)))
+    return COVER_BUCKETS[bisect.bisect_left(COVER_BUCKETS, w)]
+
+def cover_source(path: str, st) -> str | None:
+    stamp = (st.st_mtime_ns, st.st_size)
+    hit = COVER_SOURCES.get(path)
+    if hit and hit[0] == stamp:
+        cache_result("cover_source", True)
+        return hit[1]
+    try:
+        row = index_db().execute("SELECT mtime_ns, size, hash FROM covers WHERE path = ?", (path,)).fetchone()
+    except sqlite3.Error:
+        row = None
+    if row and (row[0], row[1]) == stamp:
+        COVER_SOURCES[path] = (stamp, row[2])
+        cache_result("cover_source", True)
+        return row[2]
+    cache_result("cover_source", False)
+    return None
+
+def remember_cover_source(path: str, st, src: str):
+    COVER_SOURCES[path] = ((st.st_mtime_ns, st.st_size), src)
+    try:
+        db = index_db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO covers (path, mtime_ns, size, hash) VALUES (?, ?, ?, ?)", (path, st.st_mtime_ns, st.st_size, src))
+    except sqlite3.Error:
+        app.logger.exception("Failed to record cover source")
+
+def cached_cover(path: str, st, bucket: int):
+    src = cover_source(path, st)
+    if src:
+        hit = disk_cache_get(COVER_CACHE, f"{src}-{bucket}")
+        if hit: return hit
+
+    data, mime = extract_cover_bytes(path)
+    src = hashlib.sha1(data).hexdigest()
+    remember_cover_source(path, st, src)
+    key = f"{src}-{bucket}"
+    hit = disk_cache_get(COVER_CACHE, key)
+    if hit: return hit
+
+    if bucket: data, mime = resize_image_bytes(data, mime, bucket)
+    disk_cache_put(COVER_CACHE, key, data, _image_exts.get(mime, "bin"))
+    return data, mime
+
 @app.get("/cover/<tid>")
 def cover_route(tid):
     try:
         path = path_for_tid(tid)
-        data, mime = extract_cover_bytes(path)
-        ver = file_mtime_epoch(path)
+        st = os.stat(path)
+        ver = media_version(path, st)
         etag = f'W/"cover-{tid}-{ver}"'
         if client_conditional_hit(etag, ver):
             resp = Response(status=304)
             return set_immutable_cache(resp, etag, ver)
         w = request.args.get("w")
-        data, mime = resize_image_bytes(data, mime, int(w) if w else None)
+        data, mime = cached_cover(path, st, cover_bucket(w) if w else 0)
         resp = Response(data, 200, mimetype=mime)
         return set_immutable_cache(resp, etag, ver)
     except:
         data, mime = fallback_cover()
         return Response(data, 200, mimetype=mime) 
 
+SPRITE_MAX = 128
+SPRITE_SIDE_MAX = 16383
+
+def sprite_columns(n: int, w: int) -> int:
+    cols = max(1, int(n ** 0.5))
+    if cols * cols < n: cols += 1
+    return max(cols, -(-n // (SPRITE_SIDE_MAX // w)))
+
+def sprite_tile(tid: str, w: int) -> Image.Image:
+    try:
+        path = path_for_tid(tid)
+        data, _ = cached_cover(path, os.stat(path), cover_bucket(w))
+    except:
+        data, _ = fallback_cover(w)
+    try:
+        img = Image.open(io.BytesIO(data)).convert("RGB")
+    except:
+        img = Image.open(io.BytesIO(fallback_cover(w)[0])).convert("RGB")
+    side = min(img.width, img.height)
+    left, top = (img.width - side) // 2, (img.height - side) // 2
+    return img.crop((left, top, left + side, top + side)).resize((w, w), Image.LANCZOS)
+
+@app.get("/api/sprite")
+def api_sprite():
+    ids = [x for x in (request.args.get("ids") or "").split(",") if x]
+    if not ids or len(ids) > SPRITE_MAX:
+        return jsonify(ok=False, error=f"Pass 1 to {SPRITE_MAX} ids"), 400
+    try: w = max(16, min(256, int(request.args.get("w") or 96)))
+    except: return jsonify(ok=False, error="Bad size"), 400
+
+    stamps = []
+    for tid in ids:
+        try: path = path_for_tid(tid); stamps.append(str(media_version(path, os.stat(path))))
+        except: stamps.append("-")
+    ver = max((int(x) for x in stamps if x != "-"), default=0)
+    key = hashlib.sha1(f"sprite-grid|{w}|{','.join(ids)}|{','.join(stamps)}".encode()).hexdigest()
+    etag = f'W/"sprite-{key}"'
+    cols = sprite_columns(len(ids), w)
+    rows = -(-len(ids) // cols)
+    layout = {tid: [(i % cols) * w, (i // cols) * w] for i, tid in enumerate(ids)}
+
+    if client_conditional_hit(etag, ver):
+        resp = Response(status=304)
+    else:
+        hit = disk_cache_get(COVER_CACHE, key)
+        if hit:
+            data, mime = hit
+        else:
+            sheet = Image.new("RGB", (w * cols, w * rows), THEME["panel2"])
+            for i, tid in enumerate(ids):
+                sheet.paste(sprite_tile(tid, w), ((i % cols) * w, (i // cols) * w))
+            bio = io.BytesIO()
+            sheet.save(bio, format="WEBP", quality=82, method=4)
+            data, mime = bio.getvalue(), "image/webp"
+            disk_cache_put(COVER_CACHE, key, data, "webp")
+        resp = Response(data, 200, mimetype=mime)
+    resp.headers["X-Sprite-Tile"] = str(w)
+    resp.headers["X-Sprite-Columns"] = str(cols)
+    resp.headers["X-Sprite-Map"] = json.dumps(layout, separators=(",", ":"))
+    return set_immutable_cache(resp, etag, ver)
+
+RATE_JOURNAL_PATH = os.path.join(os.path.dirname(CONFIG_PATH), "rate_journal.jsonl")
+RATE_COALESCE = 0.25
+RATE_RETRIES = 3
+RATE_WORKERS = int(CONFIG.get("write_workers") or 4)
+RATES = {"pending": {}, "heap": [], "writing": set(), "finished": [], "written": 0, "bytes_written": 0, "resized": 0, "failed": {}, "seq": 0, "journal": 0, "waiters": {}, "thread": None}
+RATE_COND = threading.Condition()
+
+def _journal_append(recs: list):
+    with open(RATE_JOURNAL_PATH, "a", encoding="utf-8") as f:
+        f.write("".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in recs))
+        f.flush()
+        os.fsync(f.fileno())
+    RATES["journal"] += len(recs)
+
+def _as_comments(c) -> list:
+    return [x for x in (c if isinstance(c, list) else [c]) if x]
+
+def _queue_intent(seq: int, path: str, rating, comments: list, delay: float = RATE_COALESCE, sidecar_rev: int | None = None):
+    job = RATES["pending"].get(path)
+    if job is None:
+        job = RATES["pending"][path] = {"rating": rating, "comments": [], "seqs": [], "due": time.monotonic() + delay, "tries": 0}
+        heapq.heappush(RATES["heap"], (job["due"], path))
+    job["rating"] = rating
+    job["comments"].extend(c for c in comments if c)
+    job["seqs"].append(seq)
+    if sidecar_rev is not None: job["sidecar_rev"] = sidecar_rev
+
+def enqueue_ratings(items: list, delay: float = RATE_COALESCE, waiter: dict | None = None, store: str | None = None) -> list:
+    if (store or ratings_store()) == "sidecar":
+        return sidecar_save(items, waiter)
+    superseded = {}
+    if store is None:
+        for path, _, _ in items:
+            row = None if path in superseded else sidecar_row(path)
+            if row: superseded[path] = row
+        if superseded:
+            folded, merged = set(), []
+            for path, rating, comment in items:
+                if path in superseded and path not in folded:
+                    folded.add(path)
+                    comment = superseded[path]["comments"] + _as_comments(comment)
+                merged.append((path, rating, comment))
+            items = merged
+    ensure_rate_writer()
+    with RATE_COND:
+        seqs, recs, revs = [], [], []
+        for path, rating, comment in items:
+            RATES["seq"] += 1
+            seqs.append(RATES["seq"])
+            rec = {"seq": RATES["seq"], "path": path, "rating": rating, "comment": comment}
+            row = superseded.pop(path, None)
+            if row: rec["sidecar_rev"] = row["rev"]
+            recs.append(rec)
+            revs.append(rec.get("sidecar_rev"))
+        if recs: _journal_append(recs)
+        for seq, (path, rating, comment), rev in zip(seqs, items, revs):
+            if waiter is not None: RATES["waiters"][seq] = waiter
+            _queue_intent(seq, path, rating, _as_comments(comment), delay, rev)
+            RATES["failed"].pop(path, None)
+        RATE_COND.notify_all()
+    return seqs
+
+def enqueue_rating(path: str, rating, comment) -> int:
+    return enqueue_ratings([(path, rating, comment)])[0]
+
+def _replay_journal():
+    intents, done = {}, set()
+    try:
+        with open(RATE_JOURNAL_PATH, "r", encoding="utf-8") as f:
+            for ln in f:
+                try: rec = json.loads(ln)
+                except ValueError: continue
+                if "done" in rec: done.update(rec["done"])
+                elif "seq" in rec: intents[rec["seq"]] = rec
+    except OSError:
+        return
+    RATES["journal"] = len(intents) + len(done)
+    for seq in sorted(intents):
+        RATES["seq"] = max(RATES["seq"], seq)
+        if seq in done: continue
+        rec = intents[seq]
+        _queue_intent(seq, rec["path"], rec.get("rating"), _as_comments(rec.get("comment")), delay=0, sidecar_rev=rec.get("sidecar_rev"))
+
+def _write_job(path: str, job: dict):
+    values = None
+    try:
+        values = write_rating(path, job["rating"], job["comments"])
+        err = None
+    except Exception as e:
+        app.logger.exception("Failed to save rating")
+        err = str(e) or e.__class__.__name__
+    job["written"] = values
+    with RATE_COND:
+        RATES["finished"].append((path, job, err))
+        RATE_COND.notify_all()
+
+def _settle_writes(finished: list):
+    written = {path: job.get("written") for path, job, err in finished if err is None}
+    if written:
+        root = CONFIG.get("library")
+        try:
+            stale = write_through(root, written)
+            if stale: update_paths(root, stale)
+        except Exception: app.logger.exception("Failed to refresh catalog after rating")
+    superseded = {path: {"rev": job["sidecar_rev"]} for path, job, err in finished if err is None and job.get("sidecar_rev") is not None}
+    if superseded: sidecar_drop(superseded)
+
+    with RATE_COND:
+        done, results = [], []
+        for path, job, err in finished:
+            RATES["writing"].discard(path)
+            if err is None:
+                RATES["written"] += 1
+                saved = job.get("written") or {}
+                RATES["bytes_written"] += saved.get("bytes_written", 0)
+                RATES["resized"] += bool(saved.get("resized"))
+                done.extend(job["seqs"])
+                results.extend((seq, None) for seq in job["seqs"])
+                for seq in job["seqs"]:
+                    w = RATES["waiters"].get(seq)
+                    if w is not None: w.setdefault("values", {})[seq] = job.get("written")
+            elif job["tries"] + 1 < RATE_RETRIES:
+                retry = dict(job, tries=job["tries"] + 1, due=time.monotonic() + 2 ** job["tries"])
+                newer = RATES["pending"].pop(path, None)
+                if newer:
+                    retry.update(rating=newer["rating"], comments=job["comments"] + newer["comments"], seqs=job["seqs"] + newer["seqs"])
+                    if newer.get("sidecar_rev") is not None: retry["sidecar_rev"] = newer["sidecar_rev"]
+                RATES["pending"][path] = retry
+                heapq.heappush(RATES["heap"], (retry["due"], path))
+            else:
+                RATES["failed"][path] = {"error": err, "rating": job["rating"], "comments": job["comments"]}
+                done.extend(job["seqs"])
+                results.extend((seq, err) for seq in job["seqs"])
+        if done:
+            try: _journal_append([{"done": done}])
+            except OSError: app.logger.exception("Failed to update rating journal")
+        for seq, err in results:
+            w = RATES["waiters"].pop(seq, None)
+            if w is None: continue
+            w["results"][seq] = err
+            if len(w["results"]) >= w["total"]: w["event"].set()
+
+def _next_due_job():
+    heap, deferred = RATES["heap"], []
+    try:
+        while heap:
+            due, path = heap[0]
+            job = RATES["pending"].get(path)
+            if job is None or job["due"] != due:
+                heapq.heappop(heap)
+                continue
+            if path in RATES["writing"]:
+                deferred.append(heapq.heappop(heap))
+                continue
+            wait_for = due - time.monotonic()
+            if wait_for > 0: return None, wait_for
+            heapq.heappop(heap)
+            return path, 0
+        return None, None
+    finally:
+        for item in deferred: heapq.heappush(heap, item)
+
+def _rate_writer():
+    pool = ThreadPoolExecutor(max_workers=RATE_WORKERS, thread_name_prefix="rate-write")
+    while True:
+        path = None
+        with RATE_COND:
+            while True:
+                if RATES["finished"]: break
+                if not RATES["pending"] and not RATES["writing"] and RATES["journal"]:
+                    try: open(RATE_JOURNAL_PATH, "w").close(); RATES["journal"] = 0
+                    except OSError: pass
+                path, wait_for = (None, None) if len(RATES["writing"]) >= RATE_WORKERS else _next_due_job()
+                if path: break
+                RATE_COND.wait(wait_for)
+            finished, RATES["finished"] = RATES["finished"], []
+            if path:
+                job = RATES["pending"].pop(path)
+                RATES["writing"].add(path)
+        if path: pool.submit(_write_job, path, job)
+        if finished: _settle_writes(finished)
+
+def ensure_rate_writer():
+    with RATE_COND:
+        if RATES["thread"] is not None: return
+        _replay_journal()
+        RATES["thread"] = threading.Thread(target=_rate_writer, name="rate-writer", daemon=True)
+        RATES["thread"].start()
+
+SIDECAR = {"count": None, "idents": {}}
+SIDECAR_LOCK = threading.RLock()
+SIDECAR_SYNC = {"running": False, "done": 0, "total": 0, "failed": 0, "stale": 0}
+SIDECAR_BATCH = 200
+
+def ratings_store() -> str:
+    return "sidecar" if CONFIG.get("ratings_store") == "sidecar" else "tags"
+
+def payload_hash(path: str, size: int) -> str:
+    h = hashlib.sha1(str(size).encode())
+    with file_lock(path).read(), open(path, "rb") as f:
+        for frac in (0.25, 0.5, 0.75):
+            f.seek(int(size * frac))
+            h.update(f.read(16384))
+    return h.hexdigest()
+
+def sidecar_ident(path: str) -> tuple[int, str]:
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    hit = SIDECAR["idents"].get(path)
+    if hit and hit[0] == stamp: return st.st_size, hit[1]
+    ph = payload_hash(path, st.st_size)
+    SIDECAR["idents"][path] = (stamp, ph)
+    return st.st_size, ph
+
+def sidecar_pending() -> int:
+    if SIDECAR["count"] is None:
+        try:
+            with SIDECAR_LOCK: SIDECAR["count"] = index_db().execute("SELECT COUNT(*) FROM sidecar").fetchone()[0]
+        except sqlite3.Error:
+            SIDECAR["count"] = 0
+    return SIDECAR["count"]
+
+def sidecar_row(path: str) -> dict | None:
+    if not sidecar_pending(): return None
+    try:
+        with SIDECAR_LOCK:
+            row = index_db().execute("SELECT size, phash, rating, comments, base, rev FROM sidecar WHERE path = ?", (path,)).fetchone()
+        if not row or sidecar_ident(path) != (row[0], row[1]): return None
+    except (sqlite3.Error, OSError):
+        return None
+    return {"rating": row[2], "comments": json.loads(row[3]), "base": row[4], "rev": row[5]}
+
+def sidecar_drop(rows: dict):
+    try:
+        with SIDECAR_LOCK:
+            db = index_db()
+            with db:
+                for path, row in rows.items():
+                    db.execute("DELETE FROM sidecar WHERE path = ? AND rev = ?", (path, row["rev"]))
+            SIDECAR["count"] = None
+    except sqlite3.Error:
+        app.logger.exception("Failed to drop superseded sidecar rows")
+
+def sidecar_comment(path: str, base, comments: list):
+    if not comments: return base
+    if os.path.splitext(path)[1].lower() in (".mp3", ".wav"): return comments[-1]
+    out = base
+    for c in comments:
+        out = c if not out or str(out).strip() == "" else f"{out} | {c}"
+    return out
+
+def sidecar_values(path: str, rating, comments: list, base) -> dict:
+    return {"rating_exact": rating, "comment": safe(sidecar_comment(path, base, comments), None)}
+
+def sidecar_overlay(path: str, meta: dict) -> dict:
+    row = sidecar_row(path)
+    if row is None: return meta
+    r = row["rating"]
+    meta["rating_exact"] = r
+    meta["rating_stars"] = round(max(0, min(5, r)) / 2, 2) if r is not None else None
+    meta["comment"] = sidecar_comment(path, meta["comment"], row["comments"])
+    return meta
+
+def sidecar_save(items: list, waiter: dict | None = None) -> list:
+    written, seqs = {}, []
+    with SIDECAR_LOCK:
+        db = index_db()
+        with db:
+            for path, rating, comment in items:
+                r = None if rating is None else round(max(0.0, min(10.0, float(rating))), 2)
+                try: ident = sidecar_ident(path)
+                except OSError: ident = None
+                row = db.execute("SELECT size, phash, comments, base, rev FROM sidecar WHERE path = ?", (path,)).fetchone()
+                if row and ident == (row[0], row[1]):
+                    comments, base, rev = json.loads(row[2]), row[3], row[4] + 1
+                else:
+                    t = CATALOG["tracks"].get(path) if CATALOG["stats"].get(path) else None
+                    base = t["comment"] if t else read_meta(path, covers=False, sidecar=False)["comment"]
+                    comments, rev = [], 1
+                comments += _as_comments(comment)
+                if ident is not None:
+                    db.execute("INSERT OR REPLACE INTO sidecar (path, size, phash, rating, comments, base, rev, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (path, ident[0], ident[1], r, json.dumps(comments, ensure_ascii=False), base, rev, time.time()))
+                    written[path] = sidecar_values(path, r, comments, base)
+                with RATE_COND:
+                    RATES["seq"] += 1
+                    seqs.append(RATES["seq"])
+                if waiter is not None:
+                    waiter["results"][seqs[-1]] = None if ident is not None else "File not found"
+        SIDECAR["count"] = None
+
+    stale = write_through(CONFIG.get("library"), written)
+    if stale: update_paths(CONFIG.get("library"), stale)
+    if waiter is not None: waiter["event"].set()
+    return seqs
+
+def _sidecar_sync_job():
+    try:
+        with SIDECAR_LOCK:
+            rows = index_db().execute("SELECT path, size, phash, rating, comments, rev FROM sidecar").fetchall()
+        SIDECAR_SYNC.update(done=0, total=len(rows), failed=0, stale=0)
+        for i in range(0, len(rows), SIDECAR_BATCH):
+            items, revs = [], []
+            for path, size, ph, rating, comments, rev in rows[i:i + SIDECAR_BATCH]:
+                try: valid = sidecar_ident(path) == (size, ph)
+                except OSError: valid = False
+                if not valid:
+                    SIDECAR_SYNC["stale"] += 1; SIDECAR_SYNC["done"] += 1
+                    continue
+                items.append((path, rating, json.loads(comments)))
+                revs.append(rev)
+            if not items: continue
+
+            waiter = {"total": len(items), "results": {}, "event": threading.Event()}
+            seqs = enqueue_ratings(items, delay=0, waiter=waiter, store="tags")
+            waiter["event"].wait()
+
+            catch_up = {}
+            with SIDECAR_LOCK:
+                db = index_db()
+                with db:
+                    for seq, (path, _, synced), rev in zip(seqs, items, revs):
+                        SIDECAR_SYNC["done"] += 1
+                        if waiter["results"].get(seq) is not None:
+                            SIDECAR_SYNC["failed"] += 1
+                            continue
+                        if db.execute("DELETE FROM sidecar WHERE path = ? AND rev = ?", (path, rev)).rowcount: continue
+                        row = db.execute("SELECT rating, comments FROM sidecar WHERE path = ?", (path,)).fetchone()
+                        if not row: continue
+                        comments = json.loads(row[1])[len(synced):]
+                        base = (waiter.get("values", {}).get(seq) or {}).get("comment")
+                        size, ph = sidecar_ident(path)
+                        db.execute("UPDATE sidecar SET size = ?, phash = ?, comments = ?, base = ? WHERE path = ?", (size, ph, json.dumps(comments, ensure_ascii=False), base, path))
+                        catch_up[path] = sidecar_values(path, row[0], comments, base)
+                SIDECAR["count"] = None
+            if catch_up: write_through(CONFIG.get("library"), catch_up)
+    except Exception:
+        app.logger.exception("Sidecar sync failed")
+    finally:
+        SIDECAR_SYNC["running"] = False
+
+def start_sidecar_sync() -> bool:
+    with SIDECAR_LOCK:
+        if SIDECAR_SYNC["running"]: return False
+        SIDECAR_SYNC["running"] = True
+    threading.Thread(target=_sidecar_sync_job, name="sidecar-sync", daemon=True).start()
+    return True
+
+@app.before_request
+def _start_rate_writer():
+    if RATES["thread"] is None: ensure_rate_writer()
+
 @app.post("/api/rate/<tid>")
 def api_rate(tid):
     try:
@@ -662,20 +2419,187 @@ def api_rate(tid):
     comment = body.get("comment")
 
     try:
-        write_rating(path, rating, comment)
-        return jsonify(ok=True)
+        if rating is not None: float(rating)
+    except (TypeError, ValueError):
+        return jsonify(ok=False, error="Bad rating"), 400
+
+    try:
+        seq = enqueue_rating(path, rating, comment)
+        return jsonify(ok=True, queued=True, seq=seq)
     except Exception as e:
-        app.logger.exception("Failed to save rating")
+        app.logger.exception("Failed to queue rating")
         return jsonify(ok=False, error=str(e)), 500
 
-def draw_card(path, width, height):
+RATE_BULK_MAX = 20000
+
+@app.post("/api/rate_bulk")
+def api_rate_bulk():
+    body = request.get_json(force=True, silent=True) or {}
+    root = CONFIG.get("library")
+    if not root: return jsonify(ok=False, error="No library selected"), 400
+
+    def bad_rating(v):
+        if v is None: return False
+        try: float(v); return False
+        except (TypeError, ValueError): return True
+
+    if isinstance(body.get("items"), list):
+        entries = [x if isinstance(x, dict) else {} for x in body["items"]]
+    elif "q" in body:
+        if "rating" not in body: return jsonify(ok=False, error="A filter needs a rating (null clears it)"), 400
+        ensure_watcher(root)
+        order, pos = catalog_order(root)
+        ids = search_tracks(body.get("q") or "", order, pos) if (body.get("q") or "").strip() else list(order)
+        entries = [{"id": tid, "rating": body["rating"], "comment": body.get("comment")} for tid in ids]
+    else:
+        return jsonify(ok=False, error="Pass items or q"), 400
+    if len(entries) > RATE_BULK_MAX:
+        return jsonify(ok=False, error=f"At most {RATE_BULK_MAX} items per request"), 400
+
+    results, queued = [], []
+    for e in entries:
+        tid = str(e.get("id") or "")
+        res = {"id": tid, "ok": False}
+        results.append(res)
+        try: path = path_for_tid(tid)
+        except Exception:
+            res["error"] = "Not found"; continue
+        if bad_rating(e.get("rating")):
+            res["error"] = "Bad rating"; continue
+        if os.path.splitext(path)[1].lower() not in TAGGABLE:
+            res["error"] = "Ratings cannot be saved to this file type"; continue
+        queued.append((res, (path, e.get("rating"), e.get("comment"))))
+
+    wait = body.get("wait", True)
+    waiter = {"total": len(queued), "results": {}, "event": threading.Event()} if wait else None
+    seqs = enqueue_ratings([item for _, item in queued], delay=0, waiter=waiter) if queued else []
+    if waiter and queued:
+        waiter["event"].wait(timeout=float(body.get("timeout") or 600))
+
+    for seq, (res, _) in zip(seqs, queued):
+        if waiter is None or seq not in waiter["results"]:
+            res.update(ok=True, queued=True)
+        elif waiter["results"][seq] is None:
+            res["ok"] = True
+        else:
+            res["error"] = waiter["results"][seq]
+    failed = sum(1 for r in results if not r["ok"])
+    return jsonify(ok=failed == 0, total=len(results), failed=failed, results=results)
+
+@app.get("/api/sidecar_status")
+def api_sidecar_status():
+    return jsonify(ok=True, mode=ratings_store(), pending=sidecar_pending(), sync=SIDECAR_SYNC)
+
+@app.post("/api/ratings_store")
+def api_ratings_store():
+    mode = ((request.get_json(force=True, silent=True) or {}).get("mode") or "").strip()
+    if mode not in ("tags", "sidecar"):
+        return jsonify(ok=False, error="mode must be tags or sidecar"), 400
+    set_config(ratings_store=mode)
+    return jsonify(ok=True, mode=mode, pending=sidecar_pending())
+
+@app.post("/api/sidecar_sync")
+def api_sidecar_sync():
+    started = start_sidecar_sync()
+    return jsonify(ok=True, started=started, pending=sidecar_pending(), sync=SIDECAR_SYNC)
+
+@app.get("/api/rate_status")
+def api_rate_status():
+    with RATE_COND:
+        pending = [(p, len(j["seqs"])) for p, j in RATES["pending"].items()]
+        writing = list(RATES["writing"])
+        failed = [{"id": tid_for(p), "path": p, "error": f["error"]} for p, f in RATES["failed"].items()]
+        written, bytes_written, resized = RATES["written"], RATES["bytes_written"], RATES["resized"]
+    return jsonify(
+        ok=True,
+        pending=sum(n for _, n in pending) + len(writing),
+        pending_files=len(pending) + len(writing),
+        pending_ids=[tid_for(p) for p, _ in pending] + [tid_for(p) for p in writing],
+        written=written,
+        bytes_written=bytes_written,
+        resized=resized,
+        failed=failed,
+    )
+
+BACKDROPS = OrderedDict()
+BACKDROP_LOCK = threading.Lock()
+
+def _lru_get(cache: OrderedDict, key, cap: int, make, name: str):
+    with BACKDROP_LOCK:
+        hit = cache.get(key)
+        if hit is not None:
+            cache.move_to_end(key)
+            cache_result(name, True)
+            return hit
+    cache_result(name, False)
+    hit = make()
+    with BACKDROP_LOCK:
+        cache[key] = hit
+        while len(cache) > cap: cache.popitem(last=False)
+    return hit
+
+def card_backdrop(cov_hash: str, cov: Image.Image, width: int, height: int, blur: int) -> Image.Image:
+    def make():
+        f = max(1, blur // 5)
+        small = cov.resize((max(1, width // f), max(1, height // f)), Image.BILINEAR, reducing_gap=2.0)
+        small = small.filter(ImageFilter.GaussianBlur(blur / f))
+        return Image.blend(small, Image.new("RGB", small.size, (12, 14, 20)), 168 / 255)
+    small = _lru_get(BACKDROPS, ("bg", cov_hash, width, height, blur), 32, make, "backdrop")
+    return small.resize((width, height), Image.BICUBIC)
+
+def card_cover(cov_hash: str, cov: Image.Image, size: int) -> Image.Image:
+    return _lru_get(BACKDROPS, ("cov", cov_hash, size), 32, lambda: cov.resize((size, size), Image.LANCZOS), "card_cover")
+
+@lru_cache(maxsize=64)
+def rounded_mask(w: int, h: int, radius: int) -> Image.Image:
+    mask = Image.new("L", (w, h), 0)
+    ImageDraw.Draw(mask).rounded_rectangle([0, 0, w, h], radius=radius, fill=255)
+    return mask
+
+@lru_cache(maxsize=None)
+def font_path(bold: bool) -> str | None:
+    here = os.path.dirname(os.path.abspath(__file__))
+    prefer = [
+        os.path.join(here, "Inter-Bold.ttf") if bold else os.path.join(here, "Inter-Regular.ttf"),
+        "Inter-Bold.ttf" if bold else "Inter-Regular.ttf",
+    ]
+    win_candidates = [
+        os.path.join(app.static_folder, "fonts", "seguiemj.ttf"),
+        os.path.join(app.static_folder, "fonts", "arialbd.ttf") if bold else os.path.join(app.static_folder, "fonts", "arial.ttf"),
+        os.path.join(app.static_folder, "fonts", "segoeuib.ttf") if bold else os.path.join(app.static_folder, "fonts", "segoeui.ttf"),
+    ]
+    pil_fonts = os.path.join(os.path.dirname(PIL.__file__), "fonts")
+    dejavu = os.path.join(pil_fonts, "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf")
+    for p in (prefer + win_candidates + [dejavu]):
+        try:
+            ImageFont.truetype(p, 12)
+            return p
+        except:
+            pass
+    return None
+
+@lru_cache(maxsize=512)
+def font_at(path: str | None, sz: int):
+    if path is None: return ImageFont.load_default()
+    return ImageFont.truetype(path, sz)
+
+def tf(bold=True, sz=48):
+    return font_at(font_path(bold), sz)
+
+@lru_cache(maxsize=65536)
+def text_width(text: str, font) -> float:
+    return font.getlength(text)
+
+def draw_card_image(path, width, height):
     COVER_SCALE = 0.75
     TEXT_SCALE = 1.00
     TITLE_SCALE = 0.67
     ARTIST_SCALE = 1.10
     RATING_SCALE = 1.75
     
+    phases = Phases("card")
     meta = read_meta(path)
+    phases.mark("meta")
     title = meta["title"] or ""
     artist = meta["artist"] or ""
     rating = meta["rating_exact"]
@@ -687,63 +2611,37 @@ def draw_card(path, width, height):
     
     s = max(0.75, width / 1080.0)
     
-    img = Image.new("RGB", (width, height), THEME["bg"])
-    draw = ImageDraw.Draw(img)
-
-    cov_bytes, _ = extract_cover_bytes(path)
+    cov_bytes, _ = extract_cover_bytes(path, meta)
+    cov_hash = hashlib.sha1(cov_bytes).hexdigest()
     cov = Image.open(io.BytesIO(cov_bytes)).convert("RGB")
+    phases.mark("cover")
     blur = max(20, int(40 * s))
-    bg = cov.resize((width, height), Image.LANCZOS).filter(ImageFilter.GaussianBlur(blur))
-    overlay = Image.new("RGBA", (width, height), (12, 14, 20, 168))
-    bg = bg.convert("RGBA"); bg.alpha_composite(overlay)
-    img.paste(bg.convert("RGB"), (0, 0))
+    img = card_backdrop(cov_hash, cov, width, height, blur)
+    phases.mark("blur")
+    draw = ImageDraw.Draw(img)
     
     pad_x = int(width * 0.06)
     pad_y = int(height * 0.06)
     pw, ph = width - 2 * pad_x, height - 2 * pad_y
     radius = max(16, int(32 * s))
-    panel = Image.new("RGBA", (pw, ph), (17, 19, 26, 220))
-    mask = Image.new("L", (pw, ph), 0)
-    ImageDraw.Draw(mask).rounded_rectangle([0, 0, pw, ph], radius=radius, fill=255)
-    img.paste(panel, (pad_x, pad_y), mask)
+    img.paste((17, 19, 26), (pad_x, pad_y, pad_x + pw, pad_y + ph), rounded_mask(pw, ph, radius))
     
     cov_size = int(min(pw, ph) * COVER_SCALE)
-    cov_round = Image.new("L", (cov_size, cov_size), 0)
-    ImageDraw.Draw(cov_round).rounded_rectangle([0, 0, cov_size, cov_size], radius=max(16, int(24 * s)), fill=255)
-    cov_img = cov.resize((cov_size, cov_size), Image.LANCZOS)
+    cov_img = card_cover(cov_hash, cov, cov_size)
     cx = pad_x + (pw - cov_size) // 2
     cy = pad_y + int(ph * 0.06)
-    img.paste(cov_img, (cx, cy), cov_round)
+    img.paste(cov_img, (cx, cy), rounded_mask(cov_size, cov_size, max(16, int(24 * s))))
+    phases.mark("composite")
     
-    def tf(bold=True, sz=48):
-        here = os.path.dirname(os.path.abspath(__file__))
-        prefer = [
-            os.path.join(here, "Inter-Bold.ttf") if bold else os.path.join(here, "Inter-Regular.ttf"),
-            "Inter-Bold.ttf" if bold else "Inter-Regular.ttf",
-        ]
-        win_candidates = [
-            os.path.join(app.static_folder, "fonts", "seguiemj.ttf"),
-            os.path.join(app.static_folder, "fonts", "arialbd.ttf") if bold else os.path.join(app.static_folder, "fonts", "arial.ttf"),
-            os.path.join(app.static_folder, "fonts", "segoeuib.ttf") if bold else os.path.join(app.static_folder, "fonts", "segoeui.ttf"),
-        ]
-        pil_fonts = os.path.join(os.path.dirname(PIL.__file__), "fonts")
-        dejavu = os.path.join(pil_fonts, "DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf")
-        for p in (prefer + win_candidates + [dejavu]):
-            try:
-                return ImageFont.truetype(p, sz)
-            except:
-                pass
-        return ImageFont.load_default()
-
     def break_word_hard(token, font, max_w):
-        out, cur = [], ""
-        for ch in token:
-            test = cur + ch
-            if draw.textlength(test, font=font) <= max_w or not cur:
-                cur = test
-            else:
-                out.append(cur); cur = ch
-        if cur: out.append(cur)
+        out = []
+        while token:
+            lo, hi = 1, len(token)
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if text_width(token[:mid], font) <= max_w: lo = mid
+                else: hi = mid - 1
+            out.append(token[:lo]); token = token[lo:]
         return out
 
     def wrap_text(text, font, max_w):
@@ -752,12 +2650,12 @@ def draw_card(path, width, height):
         lines, cur = [], ""
         for w in words:
             cand = (cur + " " + w).strip() if cur else w
-            if draw.textlength(cand, font=font) <= max_w:
+            if text_width(cand, font) <= max_w:
                 cur = cand
             else:
                 if cur:
                     lines.append(cur); cur = ""
-                if draw.textlength(w, font=font) > max_w:
+                if text_width(w, font) > max_w:
                     parts = break_word_hard(w, font, max_w)
                     lines.extend(parts[:-1]); cur = parts[-1]
                 else:
@@ -771,9 +2669,9 @@ def draw_card(path, width, height):
     text_bottom = pad_y + ph - max(90, int(120 * s))
     text_h_avail = max(120, text_bottom - text_top)
 
-    title_sz = max(24, int(BASE_TITLE_PX  * s * TITLE_SCALE))
-    artist_sz = max(16, int(BASE_ARTIST_PX * s * ARTIST_SCALE))
-    meta_sz = max(14, int(BASE_TEXT_PX   * s * TEXT_SCALE))
+    title0 = max(24, int(BASE_TITLE_PX  * s * TITLE_SCALE))
+    artist0 = max(16, int(BASE_ARTIST_PX * s * ARTIST_SCALE))
+    meta0 = max(14, int(BASE_TEXT_PX   * s * TEXT_SCALE))
 
     lh_title = lambda sz: int(sz * 1.22)
     lh_artist = lambda sz: int(sz * 1.12)
@@ -785,70 +2683,145 @@ def draw_card(path, width, height):
         rating_str = f"{rtxt}/10"
     meta_text = (f"{rating_str} - {comment}" if (rating_str and comment) else rating_str or comment or "")
 
-    for _ in range(40):
-        ft = tf(True, title_sz); fa = tf(False, artist_sz)
-
-        title_lines  = wrap_text(title,  ft, max_w) or [""]
-        artist_lines = wrap_text(artist, fa, max_w) or [""]
-
-        meta_rating_sz = int(meta_sz * RATING_SCALE)
-        fm = tf(False, meta_rating_sz)
-        meta_lines = wrap_text(meta_text, fm, max_w) if meta_text else []
-
-        gap_title_artist = max(4, int(6 * s))
-        extra_gap = lh_artist(artist_sz) if meta_lines else 0
-
-        total_h = (
-            len(title_lines)  * lh_title(title_sz) +
-            gap_title_artist +
-            len(artist_lines) * lh_artist(artist_sz) +
-            extra_gap +
-            len(meta_lines)   * lh_meta(meta_rating_sz)
-        )
-
-        if total_h <= text_h_avail:
-            break
-
-        scale = max(0.85, text_h_avail / (total_h + 1e-6))
-        title_sz  = max(24, int(title_sz  * scale))
-        artist_sz = max(16, int(artist_sz * scale))
-        meta_sz   = max(14, int(meta_sz   * scale))
+    layouts = {}
+    def layout(n):
+        if n not in layouts:
+            f = n / title0
+            title_sz = max(24, int(title0 * f))
+            artist_sz = max(16, int(artist0 * f))
+            meta_rating_sz = int(max(14, int(meta0 * f)) * RATING_SCALE)
+            ft = tf(True, title_sz); fa = tf(False, artist_sz); fm = tf(False, meta_rating_sz)
+
+            title_lines  = wrap_text(title,  ft, max_w) or [""]
+            artist_lines = wrap_text(artist, fa, max_w) or [""]
+            meta_lines = wrap_text(meta_text, fm, max_w) if meta_text else []
+
+            gap_title_artist = max(4, int(6 * s))
+            extra_gap = lh_artist(artist_sz) if meta_lines else 0
+            total_h = (
+                len(title_lines)  * lh_title(title_sz) +
+                gap_title_artist +
+                len(artist_lines) * lh_artist(artist_sz) +
+                extra_gap +
+                len(meta_lines)   * lh_meta(meta_rating_sz)
+            )
+            layouts[n] = (total_h <= text_h_avail, title_sz, artist_sz, meta_rating_sz, ft, fa, fm, title_lines, artist_lines, meta_lines)
+        return layouts[n]
+
+    lo, hi = 0, title0
+    if not layout(hi)[0]:
+        hi -= 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if layout(mid)[0]: lo = mid
+            else: hi = mid - 1
+    _, title_sz, artist_sz, meta_rating_sz, ft, fa, fm, title_lines, artist_lines, meta_lines = layout(hi)
+    phases.mark("text_fit")
 
     def draw_center_lines(lines, font, y0, line_h, fill=(255,255,255)):
         ycur = y0
         for ln in lines:
-            wln = draw.textlength(ln, font=font)
+            wln = text_width(ln, font)
             x = (width - wln) / 2
             draw.text((x, ycur), ln, font=font, fill=fill)
             ycur += line_h
         return ycur
 
     y = text_top
-    ft = tf(True, title_sz); fa = tf(False, artist_sz)
-    title_lines  = wrap_text(title,  ft, max_w) or [""]
-    artist_lines = wrap_text(artist, fa, max_w) or [""]
-
     y = draw_center_lines(title_lines, ft, y, lh_title(title_sz))
     y += max(4, int(6 * s))
     y = draw_center_lines(artist_lines, fa, y, lh_artist(artist_sz))
 
-    meta_rating_sz = int(meta_sz * RATING_SCALE)
-    fm = tf(False, meta_rating_sz)
-    meta_lines = wrap_text(meta_text, fm, max_w) if meta_text else []
     if meta_lines:
         y += lh_artist(artist_sz)
         draw_center_lines(meta_lines, fm, y, lh_meta(meta_rating_sz))
+    phases.mark("text_draw")
+
+    return img
 
+def encode_card(img: Image.Image, quality: str = "full") -> tuple[bytes, str]:
+    phases = Phases("card", quality=quality)
     bio = io.BytesIO()
-    img.save(bio, format="PNG")
-    bio.seek(0)
+    if quality == "preview":
+        try:
+            img.save(bio, format="WEBP", quality=82, method=3)
+            mime = "image/webp"
+        except:
+            bio = io.BytesIO()
+            img.save(bio, format="JPEG", quality=85)
+            mime = "image/jpeg"
+    else:
+        img.save(bio, format="PNG", compress_level=3)
+        mime = "image/png"
+    phases.mark("encode")
+    return bio.getvalue(), mime
+
+def draw_card(path, width, height):
+    bio = io.BytesIO(encode_card(draw_card_image(path, width, height))[0])
     return bio
 
+CARD_MEM_CAP = int(CONFIG.get("card_cache_mem_mb") or 64) * 1024 * 1024
+CARD_MEM = OrderedDict()
+CARD_MEM_STATE = {"bytes": 0}
+CARD_LOCK = threading.Lock()
+CARD_CACHE = disk_cache("cards", CONFIG.get("card_cache_mb") or 256)
+
+def card_style_version() -> str:
+    h = hashlib.sha1(json.dumps(THEME, sort_keys=True).encode())
+    fonts = os.path.join(app.static_folder, "fonts")
+    here = os.path.dirname(os.path.abspath(__file__))
+    for p in [os.path.join(here, "Inter-Bold.ttf"), os.path.join(here, "Inter-Regular.ttf")] + ([os.path.join(fonts, n) for n in sorted(os.listdir(fonts))] if os.path.isdir(fonts) else []):
+        try: h.update(f"{p}:{os.stat(p).st_mtime_ns}".encode())
+        except OSError: pass
+    return h.hexdigest()[:12]
+
+CARD_STYLE = card_style_version()
+
+def card_mem_get(key: str):
+    with CARD_LOCK:
+        data = CARD_MEM.get(key)
+        if data is not None: CARD_MEM.move_to_end(key)
+    cache_result("cards_mem", data is not None)
+    return data
+
+def card_mem_put(key: str, data: bytes, mime: str):
+    with CARD_LOCK:
+        old = CARD_MEM.pop(key, None)
+        if old is not None: CARD_MEM_STATE["bytes"] -= len(old[0])
+        CARD_MEM[key] = (data, mime); CARD_MEM_STATE["bytes"] += len(data)
+        while CARD_MEM_STATE["bytes"] > CARD_MEM_CAP and len(CARD_MEM) > 1:
+            _, victim = CARD_MEM.popitem(last=False)
+            CARD_MEM_STATE["bytes"] -= len(victim[0])
+
+def card_stamp(path: str, st) -> str:
+    t = CATALOG["tracks"].get(path)
+    if t and CATALOG["stats"].get(path) == (st.st_mtime_ns, st.st_size):
+        return t.get("card_v") or card_version(t["mtime"], t["rating_exact"], t["comment"])
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+def card_key(tid: str, path: str, st, w: int, h: int, quality: str = "full") -> str:
+    return f"{tid}-{w}x{h}-{card_stamp(path, st)}-{CARD_STYLE}" + ("-preview" if quality == "preview" else "")
+
+def preview_size(w: int, h: int) -> tuple[int, int]:
+    pw = min(w, max(810, w // 2))
+    return pw, max(1, round(h * pw / w))
+
+def cached_card(path: str, key: str, w: int, h: int, quality: str = "full") -> tuple[bytes, str]:
+    hit = card_mem_get(key) or disk_cache_get(CARD_CACHE, key)
+    if hit:
+        data, mime = hit
+    else:
+        data, mime = encode_card(draw_card_image(path, w, h), quality)
+        disk_cache_put(CARD_CACHE, key, data, _image_exts.get(mime, "bin"))
+    card_mem_put(key, data, mime)
+    return data, mime
+
 @app.get("/api/render/<tid>")
 @app.get("/api/render/<tid>/<path:fname>")
 def api_render(tid, fname=None):
     try:
         path = path_for_tid(tid)
+        st = os.stat(path)
     except:
         return Response("Not found", 404)
 
@@ -857,23 +2830,506 @@ def api_render(tid, fname=None):
     w = max(600, min(4096, w))
     h = max(600, min(4096, h))
 
-    out = draw_card(path, w, h)
+    quality = "preview" if request.args.get("quality") == "preview" else "full"
+    if quality == "preview":
+        w, h = preview_size(w, h)
 
     if fname:
         fname = safe_filename(fname)
     else:
         fname = "card.png"
 
-    ver = file_mtime_epoch(path)
-    etag = f'W/"card-{tid}-{w}x{h}-{ver}"'
+    ver = int(st.st_mtime)
+    etag = f'W/"card-{tid}-{w}x{h}-{card_stamp(path, st)}-{CARD_STYLE}-{quality}"'
     if client_conditional_hit(etag, ver):
         resp = Response(status=304)
         return set_immutable_cache(resp, etag, ver)
-    resp = send_file(out, mimetype="image/png", as_attachment=False, download_name=fname)
+
+    data, mime = cached_card(path, card_key(tid, path, st, w, h, quality), w, h, quality)
+    if mime != "image/png": fname = fname[:-4] + "." + _image_exts.get(mime, "bin")
+    resp = send_file(io.BytesIO(data), mimetype=mime, as_attachment=False, download_name=fname)
     return set_immutable_cache(resp, etag, ver)
 
-if __name__ == "__main__":    
-    if hostall[0]:    
-        app.run(host="0.0.0.0", port=hostall[1], debug=True)
+EXPORT_JOBS = {}
+EXPORT_LOCK = threading.Lock()
+EXPORT_TTL = 600
+
+def _export_prune(now: float):
+    for jid, job in list(EXPORT_JOBS.items()):
+        if job["status"] != "running" and now - job["touched"] > EXPORT_TTL:
+            del EXPORT_JOBS[jid]
+
+def render_executor():
+    workers = int(CONFIG.get("render_workers") or max(1, (os.cpu_count() or 2) - 1))
+    if (CONFIG.get("render_pool") or "process") == "thread":
+        return ThreadPoolExecutor(max_workers=workers), workers
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")), workers
+
+def _render_png(path: str, w: int, h: int) -> bytes:
+    return draw_card(path, w, h).getvalue()
+
+class _ZipSink(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+    def writable(self):
+        return True
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+    def drain(self) -> bytes:
+        out = b"".join(self.chunks)
+        self.chunks.clear()
+        return out
+
+def export_cards(job: dict):
+    w, h = job["w"], job["h"]
+    ex, workers = None, 1
+    pending = {}
+    items = iter(job["items"])
+    exhausted = False
+    try:
+        while not job["canceled"]:
+            while not exhausted and len(pending) < workers * 2 and not job["canceled"]:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                tid, path, name = item
+                try: st = os.stat(path)
+                except OSError:
+                    job["failed"] += 1; job["done"] += 1
+                    continue
+                key = card_key(tid, path, st, w, h)
+                hit = card_mem_get(key) or disk_cache_get(CARD_CACHE, key)
+                if hit:
+                    yield name, hit[0]
+                    continue
+                if ex is None: ex, workers = render_executor()
+                pending[ex.submit(_render_png, path, w, h)] = name
+            if not pending:
+                if exhausted: return
+                continue
+            finished, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name = pending.pop(fut)
+                try:
+                    data = fut.result()
+                except Exception:
+                    app.logger.exception("Card export failed for %s", name)
+                    job["failed"] += 1; job["done"] += 1
+                    continue
+                yield name, data
+    finally:
+        if ex is not None: ex.shutdown(wait=False, cancel_futures=True)
+
+def export_stream(job: dict):
+    sink = _ZipSink()
+    try:
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zf:
+            for name, data in export_cards(job):
+                zi = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                zf.writestr(zi, data)
+                job["done"] += 1
+                yield sink.drain()
+        yield sink.drain()
+    finally:
+        with EXPORT_LOCK:
+            job["status"] = "canceled" if job["canceled"] else "done"
+            job["items"] = ()
+            job["touched"] = time.monotonic()
+
+@app.post("/api/export_start")
+def api_export_start():
+    root = CONFIG.get("library")
+    if not root: return jsonify(ok=False, error="No library selected"), 400
+    body = request.get_json(force=True, silent=True) or {}
+    try:
+        w = max(600, min(4096, int(body.get("w") or DEFAULT_IMAGE_SIZE[0])))
+        h = max(600, min(4096, int(body.get("h") or DEFAULT_IMAGE_SIZE[1])))
+    except (TypeError, ValueError):
+        return jsonify(ok=False, error="Bad size"), 400
+
+    ensure_watcher(root)
+    order, pos = catalog_order(root)
+    if body.get("ids"):
+        ids = [str(x) for x in body["ids"]]
+    elif (body.get("q") or "").strip():
+        ids = search_tracks(body["q"], order, pos)
+    else:
+        ids = list(order)
+    with INDEX_LOCK:
+        items, seen = [], {}
+        for tid in ids:
+            path = CATALOG["ids"].get(tid)
+            if not path: continue
+            t = CATALOG["tracks"][path]
+            base = safe_filename(t.get("display_title") or t.get("title") or "card")[:-4]
+            n = seen[base] = seen.get(base, 0) + 1
+            items.append((tid, path, f"{base} ({n}).png" if n > 1 else f"{base}.png"))
+
+    job_id = uuid.uuid4().hex
+    now = time.monotonic()
+    with EXPORT_LOCK:
+        _export_prune(now)
+        EXPORT_JOBS[job_id] = {"status": "pending", "done": 0, "failed": 0, "total": len(items), "canceled": False, "items": items, "w": w, "h": h, "touched": now}
+    return jsonify(ok=True, job_id=job_id, total=len(items), url=f"/api/export/{job_id}/cards.zip")
+
+@app.get("/api/export/<job_id>/<path:fname>")
+def api_export_download(job_id, fname):
+    with EXPORT_LOCK:
+        job = EXPORT_JOBS.get(job_id)
+        if not job or job["status"] != "pending":
+            return Response("Not found", 404)
+        job["status"] = "running"
+    resp = Response(export_stream(job), 200, mimetype="application/zip")
+    zip_name = re.sub(r'[^\w .()\-]+', '_', fname).strip(" .") or "cards.zip"
+    resp.headers["Content-Disposition"] = f'attachment; filename="{zip_name}"'
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+@app.get("/api/export_status")
+def api_export_status():
+    jid = request.args.get("job_id", "")
+    with EXPORT_LOCK:
+        _export_prune(time.monotonic())
+        job = EXPORT_JOBS.get(jid)
+        if not job:
+            return jsonify(ok=False, done=False)
+        finished = job["status"] in ("done", "canceled")
+        if finished:
+            EXPORT_JOBS.pop(jid, None)
+        info = dict(status=job["status"], rendered=job["done"], failed=job["failed"], total=job["total"])
+    return jsonify(ok=True, done=finished, **info)
+
+@app.post("/api/export_cancel")
+def api_export_cancel():
+    body = request.get_json(force=True, silent=True) or {}
+    with EXPORT_LOCK:
+        job = EXPORT_JOBS.get(body.get("job_id") or request.args.get("job_id", ""))
+        if not job:
+            return jsonify(ok=False), 404
+        job["canceled"] = True
+        if job["status"] == "pending":
+            job["status"] = "canceled"
+            job["items"] = ()
+            job["touched"] = time.monotonic()
+    return jsonify(ok=True)
+
+KEEPALIVE_DRAIN = 1024 * 1024
+
+class RequestBody:
+    def __init__(self, f, left: int):
+        self.f, self.left = f, left
+
+    def _take(self, size) -> int:
+        return self.left if size is None or size < 0 else min(size, self.left)
+
+    def read(self, size: int = -1) -> bytes:
+        if self.left <= 0: return b""
+        data = self.f.read(self._take(size))
+        self.left -= len(data)
+        if not data: self.left = 0
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        if self.left <= 0: return b""
+        data = self.f.readline(self._take(size))
+        self.left -= len(data)
+        if not data: self.left = 0
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+class KeepAliveHandler(ServerHandler):
+    http_version = "1.1"
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        rh = self.request_handler
+        if "Content-Length" not in self.headers and not self.status.startswith(("204", "304")):
+            rh.close_connection = True
+        if rh.close_connection: self.headers["Connection"] = "close"
+        elif rh.request_version == "HTTP/1.0": self.headers["Connection"] = "keep-alive"
+
+    def handle_error(self):
+        self.request_handler.close_connection = True
+        super().handle_error()
+
+    def finish_response(self):
+        seq = self.environ.get("rately.feed")
+        if seq is None: return super().finish_response()
+        rh = self.request_handler
+        try:
+            for data in self.result: self.write(data)
+            if not self.headers_sent: self.send_headers()
+        except Exception:
+            rh.server.feed_slots.release()
+            raise
+        self.close()
+        rh.server.adopt_feed(rh, seq)
+
+class PooledRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, request, client_address, server):
+        self.request, self.client_address, self.server = request, client_address, server
+        self.setup()
+
+    def setup(self):
+        super().setup()
+        try: self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError: pass
+
+    def get_environ(self):
+        env = super().get_environ()
+        env["rately.events"] = self.server
+        return env
+
+    def buffered(self) -> bool:
+        self.connection.settimeout(0)
+        try: return bool(self.rfile.peek(1))
+        except OSError: return False
+        finally: self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        self.close_connection = True
+        try: self.raw_requestline = self.rfile.readline(65537)
+        except OSError: self.raw_requestline = b""
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = self.request_version = self.command = ""
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request(): return
+        if "chunked" in (self.headers.get("Transfer-Encoding") or "").lower():
+            self.send_error(411)
+            self.close_connection = True
+            return
+
+        environ = self.get_environ()
+        try: n = max(0, int(environ.get("CONTENT_LENGTH") or 0))
+        except ValueError: n = 0
+        body = RequestBody(self.rfile, n)
+        handler = KeepAliveHandler(body, self.wfile, self.get_stderr(), environ, multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+        if self.close_connection: return
+        if body.left > KEEPALIVE_DRAIN:
+            self.close_connection = True
+            return
+        try:
+            while body.left > 0 and body.read(65536): pass
+        except OSError:
+            self.close_connection = True
+
+FEED_PING = 15
+FEED_BUFFER_MAX = 1 << 20
+
+class PooledWSGIServer(WSGIServer):
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, app, threads: int, queue_limit: int, backlog: int, timeout: float, keepalive: float, idle_limit: int, events_limit: int):
+        self.request_queue_size = backlog
+        super().__init__((host, port), type("Handler", (PooledRequestHandler,), {"timeout": timeout}))
+        self.set_app(app)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+        self.slots = threading.BoundedSemaphore(threads + queue_limit)
+        self.keepalive, self.idle_limit = keepalive, idle_limit
+        self.parked, self.closing = deque(), False
+        self.feed_slots = threading.BoundedSemaphore(events_limit)
+        self.adopted, self.feeds = deque(), {}
+        self.selector = selectors.DefaultSelector()
+        self.waker, self.wake_w = socket.socketpair()
+        self.waker.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+        with EVENT_LOCK: EVENT_HOOKS.append(self._wake)
+        self.idle_thread = threading.Thread(target=self._idle_loop, name="http-idle", daemon=True)
+        self.idle_thread.start()
+
+    def _wake(self):
+        try: self.wake_w.send(b"\0")
+        except OSError: pass
+
+    def reserve_feed(self) -> bool:
+        return self.feed_slots.acquire(blocking=False)
+
+    def adopt_feed(self, handler, seq: int):
+        handler.detached = True
+        self.adopted.append((handler, seq))
+        self._wake()
+
+    def _drop_feed(self, handler):
+        self.feeds.pop(handler, None)
+        try: self.selector.unregister(handler.request)
+        except (KeyError, ValueError): pass
+        self._hang_up(handler, handler.request)
+        self.feed_slots.release()
+
+    def _flush_feed(self, handler, feed):
+        try:
+            if feed["out"]: del feed["out"][:handler.request.send(feed["out"])]
+        except BlockingIOError: pass
+        except OSError:
+            self._drop_feed(handler)
+            return
+        if len(feed["out"]) > FEED_BUFFER_MAX:
+            self._drop_feed(handler)
+            return
+        mask = selectors.EVENT_READ | (selectors.EVENT_WRITE if feed["out"] else 0)
+        if mask != feed["mask"]:
+            feed["mask"] = mask
+            self.selector.modify(handler.request, mask, handler)
+
+    def _pump_feeds(self):
+        now = time.monotonic()
+        with EVENT_LOCK:
+            for handler, feed in list(self.feeds.items()):
+                frames, feed["seq"] = event_frames(feed["seq"])
+                if frames: feed["out"] += "".join(frames).encode("utf-8")
+                elif now - feed["sent"] >= FEED_PING: feed["out"] += b": ping\n\n"
+                else: continue
+                feed["sent"] = now
+        for handler, feed in list(self.feeds.items()):
+            if feed["out"]: self._flush_feed(handler, feed)
+
+    def _feed_event(self, handler, mask):
+        feed = self.feeds[handler]
+        if mask & selectors.EVENT_READ:
+            try: data = handler.request.recv(4096)
+            except BlockingIOError: data = None
+            except OSError: data = b""
+            if data == b"":
+                self._drop_feed(handler)
+                return
+        if mask & selectors.EVENT_WRITE: self._flush_feed(handler, feed)
+
+    def _refuse(self, request):
+        try: request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n")
+        except OSError: pass
+
+    def _dispatch(self, handler, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self._refuse(request)
+            self._hang_up(handler, request)
+            return
+        self.pool.submit(self._serve, handler, request, client_address)
+
+    def process_request(self, request, client_address):
+        self._dispatch(None, request, client_address)
+
+    def _serve(self, handler, request, client_address):
+        keep = False
+        try:
+            if handler is None: handler = self.RequestHandlerClass(request, client_address, self)
+            handler.handle_one_request()
+            keep = not handler.close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.slots.release()
+        if getattr(handler, "detached", False): return
+        if not keep: self._hang_up(handler, request)
+        elif handler.buffered(): self._dispatch(handler, request, client_address)
+        else:
+            self.parked.append(handler)
+            self._wake()
+
+    def _hang_up(self, handler, request):
+        if handler is not None:
+            try: handler.finish()
+            except Exception: pass
+        self.shutdown_request(request)
+
+    def _idle_loop(self):
+        deadlines = {}
+        while not self.closing:
+            for key, mask in self.selector.select(timeout=1.0):
+                if key.fileobj is self.waker:
+                    try:
+                        while self.waker.recv(4096): pass
+                    except OSError: pass
+                    continue
+                if key.data in self.feeds:
+                    self._feed_event(key.data, mask)
+                    continue
+                self.selector.unregister(key.fileobj)
+                deadlines.pop(key.data, None)
+                self._dispatch(key.data, key.fileobj, key.data.client_address)
+            while self.parked:
+                handler = self.parked.popleft()
+                if len(deadlines) >= self.idle_limit:
+                    self._hang_up(handler, handler.request)
+                    continue
+                try: self.selector.register(handler.request, selectors.EVENT_READ, handler)
+                except (OSError, ValueError):
+                    self._hang_up(handler, handler.request)
+                    continue
+                deadlines[handler] = time.monotonic() + self.keepalive
+            while self.adopted:
+                handler, seq = self.adopted.popleft()
+                try:
+                    handler.request.setblocking(False)
+                    self.selector.register(handler.request, selectors.EVENT_READ, handler)
+                except (OSError, ValueError):
+                    self._hang_up(handler, handler.request)
+                    self.feed_slots.release()
+                    continue
+                self.feeds[handler] = {"seq": seq, "out": bytearray(), "sent": time.monotonic(), "mask": selectors.EVENT_READ}
+            self._pump_feeds()
+            now = time.monotonic()
+            for handler in [h for h, t in deadlines.items() if t <= now]:
+                del deadlines[handler]
+                self.selector.unregister(handler.request)
+                self._hang_up(handler, handler.request)
+        for handler in list(deadlines): self._hang_up(handler, handler.request)
+        for handler in list(self.feeds): self._drop_feed(handler)
+
+    def server_close(self):
+        super().server_close()
+        self.closing = True
+        with EVENT_LOCK:
+            if self._wake in EVENT_HOOKS: EVENT_HOOKS.remove(self._wake)
+        self._wake()
+        self.idle_thread.join(timeout=2)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+def serve(host: str, port: int, dev: bool = False, reload: bool = True):
+    if dev:
+        app.run(host=host, port=port, debug=True, use_reloader=reload)
+        return
+    threads = int(CONFIG.get("server_threads") or 16)
+    queue_limit = int(CONFIG.get("server_queue") or 64)
+    backlog = int(CONFIG.get("server_backlog") or 128)
+    timeout = float(CONFIG.get("server_timeout") or 30)
+    keepalive = float(CONFIG.get("server_keepalive") or 15)
+    mode = CONFIG.get("server") or "auto"
+    global EVENT_HOLDS
+    EVENT_HOLDS = threading.BoundedSemaphore(max(1, threads // 4))
+    if mode == "waitress" or (mode == "auto" and WAITRESS_OK):
+        if not WAITRESS_OK:
+            print("waitress is not installed, using the built-in threaded server")
+        else:
+            print(f"Serving on http://{host}:{port} with waitress ({threads} threads)")
+            waitress.serve(app, host=host, port=port, threads=threads, connection_limit=threads + queue_limit,
+                           backlog=backlog, channel_timeout=timeout, ident="Rately")
+            return
+    srv = PooledWSGIServer(host, port, app, threads, queue_limit, backlog, timeout, keepalive, int(CONFIG.get("server_idle_limit") or 256), int(CONFIG.get("server_events_limit") or 64))
+    print(f"Serving on http://{host}:{port} ({threads} threads)")
+    try:
+        srv.serve_forever()
+    finally:
+        srv.server_close()
+
+if __name__ == "__main__":
+    dev, reload = "--dev" in sys.argv, "--no-reload" not in sys.argv
+    if hostall[0]:
+        serve("0.0.0.0", hostall[1], dev, reload)
     else:
-        app.run(host="127.0.0.1", port=3478, debug=True)
+        serve("127.0.0.1", 3478, dev, reload)